@@ -0,0 +1,130 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Solver benchmarks. Usage:
+python3.7 benchmark.py mpc [N ...]
+python3.7 benchmark.py qp [trials]
+"""
+import sys
+import time
+
+import numpy as np
+
+import mpc
+import qp
+
+
+def mpc_instance(rng):
+    # random but physically sensible MPC inputs: small yaw, feet below the hips, both feet in contact
+    phi = rng.uniform(-0.5, 0.5)
+    rz_phi = np.array([[np.cos(phi), np.sin(phi), 0],
+                       [-np.sin(phi), np.cos(phi), 0],
+                       [0, 0, 1]])
+    r1 = np.array([0, 0, -0.8325]) + rng.normal(0, 0.02, 3)
+    r2 = np.array([0, 0, -0.8325]) + rng.normal(0, 0.02, 3)
+    x_in = rng.normal(0, 0.05, 12)
+    x_ref = np.zeros(12)
+    return dict(rz_phi=rz_phi, r1=r1, r2=r2, x_in=x_in, x_ref=x_ref, c_l=1, c_r=1)
+
+
+def bench_mpc(horizons=(10, 20, 40, 80), trials=20):
+    """
+    Mean MPC solve time against horizon length for each backend.
+    Every backend sees the same sequence of slowly varying inputs, like consecutive solves when walking.
+    """
+    backends = [('qpoases', dict(solver='qpoases')),
+                ('qpoases condensed', dict(solver='qpoases', condensed=True)),
+                ('hpipm', dict(solver='hpipm')),
+                ('qpoases rti', dict(solver='qpoases', rti=True))]
+    print("N".ljust(6) + "".join(name.rjust(20) for name, kwargs in backends) + "   (ms per solve)")
+    for N in horizons:
+        row = str(N).ljust(6)
+        for name, kwargs in backends:
+            force = mpc.Mpc(N=N, **kwargs)
+            rng = np.random.default_rng(0)
+            inputs = mpc_instance(rng)
+            force.mpcontrol(**inputs)  # first solve includes setup, leave it out
+            t = 0
+            for i in range(trials):
+                inputs['x_in'] = inputs['x_in'] + rng.normal(0, 0.005, 12)
+                t0 = time.perf_counter()
+                force.mpcontrol(**inputs)
+                t += time.perf_counter() - t0
+            row += ("%.2f" % (t / trials * 1e3)).rjust(20)
+        print(row)
+
+
+class QpInstance:
+    # stands in for wbc.Control, holding random but consistent whole body QP data
+
+    def __init__(self, rng):
+        self.J = rng.normal(0, 0.3, (3, 4))
+        M = rng.normal(0, 1, (3, 3))
+        self.Mx = np.dot(M, M.T) + np.eye(3)
+        self.x_dd_des = rng.normal(0, 10, (3, 1))
+        self.grav = np.dot(self.J.T, rng.normal(0, 50, 3))  # the equalities are only consistent in range(J.T)
+        self.fr_mpc = rng.normal(0, 50, 3)
+
+
+def bench_qp(trials=1000):
+    """
+    Checks the numpy whole body QP solver against qpOASES on random instances, then times both per call.
+    """
+    rng = np.random.default_rng(0)
+    instances = [QpInstance(rng) for i in range(trials)]
+    a = qp.Qp(controller=instances[0], solver='numpy')
+    b = qp.Qp(controller=instances[0], solver='casadi')
+    err = 0
+    n_active = 0
+    n_fail = 0
+    for inst in instances:
+        a.active[:] = False  # unrelated instances, so solve each one cold
+        b.x_prev[:] = 0
+        b.lam_x_prev[:] = 0
+        b.lam_g_prev[:] = 0
+        z = a.active_set(inst.J, inst.Mx, inst.x_dd_des, inst.grav, inst.fr_mpc)
+        b.controller = inst
+        b.qpcontrol(inst.fr_mpc)
+        if b.solver.stats()['success'] is False:
+            n_fail += 1  # qpOASES can give up on the rank deficient equalities
+            continue
+        n_active += np.sum(a.active)
+        err = max(err, np.max(np.abs(z - b.x_prev)))
+    print("max difference to qpOASES: %.2e (%d instances, %d active bounds, %d qpOASES failures)"
+          % (err, trials, n_active, n_fail))
+
+    for name in ('numpy', 'casadi'):
+        solver = qp.Qp(controller=instances[0], solver=name)
+        t0 = time.perf_counter()
+        for inst in instances:
+            solver.controller = inst
+            solver.qpcontrol(inst.fr_mpc)
+        print(name.ljust(10) + ("%.1f" % ((time.perf_counter() - t0) / trials * 1e6)).rjust(10) + " us per solve")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'mpc':
+        if len(sys.argv) > 2:
+            bench_mpc(horizons=[int(n) for n in sys.argv[2:]])
+        else:
+            bench_mpc()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'qp':
+        if len(sys.argv) > 2:
+            bench_qp(trials=int(sys.argv[2]))
+        else:
+            bench_qp()
+    else:
+        print(__doc__.split("\n\n")[-1])
@@ -0,0 +1,73 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import hashlib
+import warnings
+import subprocess
+
+import casadi as cs
+
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+compiler = 'gcc'
+flags = ['-O3', '-fPIC', '-shared']
+
+
+def key_hash(key):
+    # short hash of anything with a stable repr (model parameters, source file contents, ...)
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def source_hash(path):
+    # hash of a source file, so cached code is rebuilt when the formulation in that file changes
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+def load(name, key, build):
+    """
+    Returns the compiled version of a CasADi Function, generating C code and compiling it
+    into a shared library in cache_dir the first time a given key is seen.
+    :param name: name of the Function returned by build
+    :param key: model parameters the Function depends on, the library is rebuilt when they change
+    :param build: callable returning the symbolic cs.Function, only called on a cache miss
+    """
+    cname = name + '_' + key_hash(key)
+    lib = os.path.join(cache_dir, cname + '.so')
+
+    if not os.path.isfile(lib):
+        fn = build()
+        os.makedirs(cache_dir, exist_ok=True)
+        # generate and compile under temporary names so parallel runs don't collide, then move into place
+        pid = str(os.getpid())
+        cg = cs.CodeGenerator(cname + '_' + pid + '.c')
+        cg.add(fn)
+        cg.generate(cache_dir + os.sep)
+        src_tmp = os.path.join(cache_dir, cname + '_' + pid + '.c')
+        tmp = lib + '.' + pid
+        try:
+            subprocess.run([compiler] + flags + [src_tmp, '-o', tmp], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            for path in (src_tmp, tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+            warnings.warn("could not compile " + cname + ", falling back to the CasADi virtual machine: " + str(e))
+            return fn
+        os.replace(src_tmp, os.path.join(cache_dir, cname + '.c'))  # kept next to the library for reference
+        os.replace(tmp, lib)
+
+    return cs.external(name, lib)
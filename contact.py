@@ -34,17 +34,20 @@ class Contact:
         self.gamma = np.exp(-la * self.dt)
         self.beta = (1 - self.gamma) / (self.gamma * self.dt)
 
-    def disturbance_torque(self, Mq, dq, tau_actuated, grav):
+    def disturbance_torque(self, Mq, dq, tau_actuated, grav, CTdq=None):
         """
         Generalized momentum-based discrete time filtered disturbance torque observer
         Isolates disturbance torque from other sources
         From:
         Contact Model Fusion for Event-Based Locomotion in Unstructured Terrains
         Gerardo Bledt, Patrick M. Wensing, Sam Ingersoll, and Sangbae Kim
+        :param CTdq: C(q, dq).T*dq, see Leg.update_dynamics. The momentum changes by
+        tau_actuated + grav + C(q, dq).T*dq + tau_d
         """
         p = np.dot(Mq, dq)
+        tau_known = tau_actuated + grav if CTdq is None else tau_actuated + grav + CTdq
         self.tau_d = self.gamma * self.delay_term \
             + self.beta * p \
-            - (1 - self.gamma) * (self.beta * p + tau_actuated + grav)
+            - (1 - self.gamma) * (self.beta * p + tau_known)
         self.delay_term = self.tau_d - self.beta * p
         return self.tau_d
@@ -37,6 +37,28 @@ class Gait:
 
     def u(self, state, prev_state, r_in, r_d, b_orient, fr_mpc, skip):
 
+        target = self.plan(state=state, prev_state=prev_state, r_in=r_in, r_d=r_d)
+
+        if state not in ('swing', 'late', 'stance', 'early'):
+            return None
+        force = self.force(state=state, fr_mpc=fr_mpc, skip=skip)
+
+        # calculate wbc control signal
+        u = -self.controller.wb_control(leg=self.robotleg, target=target, b_orient=b_orient, force=force)
+
+        return u
+
+    def force(self, state, fr_mpc, skip):
+        # reaction force reference for this tick, None for position control only
+        if state == 'stance' or state == 'early':
+            if skip is True:  # skip force control this time because robot is already in correct pose
+                return None
+            return fr_mpc
+        return None
+
+    def plan(self, state, prev_state, r_in, r_d):
+        # foot target for this tick, [x, y, z, alpha, beta, gamma]
+
         self.target = np.hstack(np.append(np.array([0, 0, -0.8325]),
                                           np.array([self.init_alpha, self.init_beta, self.init_gamma])))
 
@@ -51,33 +73,14 @@ class Gait:
                                               np.array([self.init_alpha, self.init_beta, self.init_gamma])))
 
             self.swing_steps += 1
-            # calculate wbc control signal
-            u = -self.controller.wb_control(leg=self.robotleg, target=self.target, b_orient=b_orient, force=None)
-
-        elif state == 'stance' or state == 'early':
-            if state == 'early' and prev_state != state:
-                # if contact has just been made early, save that contact point as the new target to stay at
-                # (stop following through with trajectory)
-                self.target = np.hstack(np.append(r_in,
-                                                  np.array([self.init_alpha, self.init_beta, self.init_gamma])))
-
-            if skip is True:  # skip force control this time because robot is already in correct pose
-                # calculate wbc control signal
-                u = -self.controller.wb_control(leg=self.robotleg, target=self.target, b_orient=b_orient,
-                                                force=None)
-            else:
-                force = fr_mpc
-                u = -self.controller.wb_control(leg=self.robotleg, target=self.target, b_orient=b_orient,
-                                                force=force)
 
-        elif state == 'late':
-            # calculate wbc control signal
-            u = -self.controller.wb_control(leg=self.robotleg, target=self.target, b_orient=b_orient, force=None)
-
-        else:
-            u = None
+        elif state == 'early' and prev_state != state:
+            # if contact has just been made early, save that contact point as the new target to stay at
+            # (stop following through with trajectory)
+            self.target = np.hstack(np.append(r_in,
+                                              np.array([self.init_alpha, self.init_beta, self.init_gamma])))
 
-        return u
+        return self.target
 
     def traj(self, x_prev, x_d, y_prev, y_d):
         # Generates cubic spline curve trajectory for foot swing
@@ -18,57 +18,37 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
 
-import csv
-
-import transforms3d
-
 from legbase import LegBase
+import legsym
+import rbd
+import lrucache
+import modeldata
+import quat
+
+# leg angles of the URDF zero pose, also the encoder calibration offsets
+q_urdf_zero = np.array([-np.pi / 2, np.pi * 32 / 180, -np.pi * 44.17556088 / 180, np.pi * 12.17556088 / 180.])
 
 
 class Leg(LegBase):
 
-    def __init__(self, leg, init_q=None, init_dq=None, **kwargs):
+    def __init__(self, leg, init_q=None, init_dq=None, symbolic=False, urdf=None, cache_size=0, cache_res=1e-3,
+                 **kwargs):
 
         if init_dq is None:
             init_dq = [0., 0., 0., 0.]  # just left leg
 
         if init_q is None:
-            init_q = [-np.pi / 2, np.pi * 32 / 180, -np.pi * 44.17556088 / 180, np.pi * 12.17556088 / 180.]
+            init_q = q_urdf_zero.tolist()
 
         self.DOF = 4
 
         LegBase.__init__(self, init_q=init_q, init_dq=init_dq, **kwargs)
 
-        # values = []
-
-        if leg == 1:
-            spryped_data = str('spryped_urdf_rev06/spryped_data_left.csv')
-        else:
-            spryped_data = str('spryped_urdf_rev06/spryped_data_right.csv')
-
-        with open(spryped_data, 'r') as csvfile:
-            data = csv.reader(csvfile, delimiter=',')
-            next(data)  # skip headers
-            values = list(zip(*(row for row in data)))  # transpose rows to columns
-            values = np.array(values)  # convert list of nested lists to array
-
-        ixx = values[1].astype(np.float)
-        ixy = values[2].astype(np.float)
-        ixz = values[3].astype(np.float)
-        iyy = values[4].astype(np.float)
-        iyz = values[5].astype(np.float)
-        izz = values[6].astype(np.float)
-
-        self.coml = values[7].astype(np.float)
-
-        with open('spryped_urdf_rev06/urdf/spryped_urdf_rev06.csv', 'r') as csvfile:
-            data_direct = csv.reader(csvfile, delimiter=',')
-            next(data_direct)  # skip headers
-            values_direct = list(zip(*(row for row in data_direct)))  # transpose rows to columns
-            values_direct = np.array(values_direct)  # convert list of nested lists to array
-
-        self.mass = values_direct[7].astype(np.float)
-        self.mass = np.delete(self.mass, 0)  # remove body value
+        data = modeldata.load()  # parsed and L/R mass checked once, see modeldata
+        side = 'left' if leg == 1 else 'right'
+        ixx, ixy, ixz, iyy, iyz, izz = data[side + '_inertia'].T
+        self.coml = data[side + '_coml']
+        self.mass = data['urdf_mass'][1:]  # remove body value
 
         # estimating init link angles
         # p = 4
@@ -77,16 +57,6 @@ class Leg(LegBase):
         # print("dist = ", dist)
         # print("angle p = ", angle)
 
-        # link masses
-        if self.mass[0] != self.mass[4]:
-            print("WARNING: femur L/R masses unequal, check CAD")
-        if self.mass[1] != self.mass[5]:
-            print("WARNING: tibiotarsus L/R masses unequal, check CAD")
-        if self.mass[2] != self.mass[6]:
-            print("WARNING: tarsometatarsus L/R masses unequal, check CAD")
-        if self.mass[3] != self.mass[7]:
-            print("WARNING: toe L/R masses unequal, check CAD")
-
         # link lengths (mm) must be manually updated
 
         L0 = .114  # femur
@@ -95,9 +65,26 @@ class Leg(LegBase):
         L3 = .061  # toe
         self.L = np.array([L0, L1, L2, L3])
 
+        # the COMs and the end effector as x = -sum(a*sin), r = b + sum(a*cos) over the angles q1, q1 + q2
+        # and q1 + q2 + q3, with y = r*cos(q0) and z = r*sin(q0), see position_com() and position()
+        l0, l1, l2, l3 = self.coml[0:4]
+        self.point_a = np.array([[0, 0, 0],
+                                 [l1, 0, 0],
+                                 [L1, l2, 0],
+                                 [L1, L2, l3],
+                                 [L1, L2, L3]])
+        self.point_b = np.array([l0, L0, L0, L0, L0])
+        self.sum_lower = np.tril(np.ones((3, 3)))  # cumulative sums as products, for gen_Jdot
+        self.sum_upper = np.triu(np.ones((3, 3))).T
+        self.ones3 = np.ones(3)
+
+        # joint limits of the leg model, knee bent backwards as at init_q. Used by inv_kinematics and reach.Reach
+        self.q_min = np.array([-np.pi / 2 - np.pi / 6, -np.pi / 3, -np.pi * 5 / 6, -np.pi])
+        self.q_max = np.array([-np.pi / 2 + np.pi / 6, np.pi * 2 / 3, 0, np.pi])
+
         # mass matrices and gravity
         self.MM = []
-        self.Fg = []
+        self.Fg = np.zeros((4, 6))  # gravity wrench on each link in the body frame, rewritten by gen_grav
         self.gravity = np.array([[0, 0, -9.807]]).T
         self.extra = np.array([[0, 0, 0]]).T
 
@@ -124,81 +111,146 @@ class Leg(LegBase):
         self.reset()
         self.q_calibration = np.array(init_q)
 
-    def gen_jacCOM0(self, q=None):
+        # scratch buffers for gen_grav and gen_Mq
+        self.body_grav = np.zeros(3)
+        self.MJ = np.zeros((6, 4))
+        self.JMJ = np.zeros((4, 4))
+
+        # kinematic snapshot, see update_kinematics. The arrays are preallocated and overwritten every tick.
+        self.tr = None  # sines and cosines from trig()
+        self.q_b = np.zeros(4)  # body and end effector quaternions for orientation()
+        self.q_ee = np.zeros(4)
+        self.JCOM = [np.zeros((6, 4)) for i in range(4)]  # COM Jacobians of the four links
+        self.JEE = np.zeros((6, 4))  # end effector Jacobian
+        self.Mq = np.zeros((4, 4))  # joint space mass matrix
+        self.pos = None  # joint and end effector positions, as position()
+        self.x_ee = None  # end effector position
+        self.pos_com = None  # link COM positions, as position_com()
+        self.REE = None  # end effector rotation matrix
+
+        # velocity product terms, see update_dynamics
+        self.Jdot = np.zeros((5, 6, 4))  # time derivatives of the four COM Jacobians and JEE
+        self.JEEdot_dq = np.zeros(6)  # JEE_dot*dq, end effector acceleration at zero joint acceleration
+        self.Cdq = np.zeros(4)  # C(q, dq)*dq, Coriolis and centrifugal torques
+        self.CTdq = np.zeros(4)  # C(q, dq).T*dq, for the momentum observer in contact.Contact
+
+        # with symbolic=True the snapshot comes from the compiled model derived in legsym instead,
+        # and the snapshot arrays become views into its output
+        self.model = None
+        if symbolic is True:
+            self.model = legsym.LegModel(self.L, self.coml, self.MM)
+            blocks = self.model.blocks
+            self.JCOM = [blocks['JCOM0'], blocks['JCOM1'], blocks['JCOM2'], blocks['JCOM3']]
+            self.JEE = blocks['JEE']
+            self.Mq = blocks['Mq']
+
+        # with urdf set to the path of a URDF, the snapshot and gravity come from the rigid body model in rbd.
+        # URDF joints turn about +-x and +-z from the zero pose, leg angles about +x and +z from q_urdf_zero.
+        self.tree = None
+        if urdf is not None:
+            if symbolic is True:
+                raise ValueError("symbolic and urdf models can't be used together")
+            self.tree = rbd.Model(urdf, tip='left toe' if leg == 1 else 'right toe')
+            self.q_sign = np.sum(self.tree.axis, axis=1)
+            self.Mq_sign = np.outer(self.q_sign, self.q_sign)
+            c3 = np.cos(q_urdf_zero[3])
+            s3 = np.sin(q_urdf_zero[3])
+            self.tip = np.array([-L3 * s3, L3 * c3, 0])  # end effector in the toe link frame
+            self.R_tip = np.array([[c3, -s3, 0],
+                                   [s3, c3, 0],
+                                   [0, 0, 1]])  # end effector orientation in the toe link frame
+            self.q_tree = np.zeros(4)
+            self.dq_tree = np.zeros(4)
+            self.ddq_tree = np.zeros(4)
+
+        # with cache_size > 0, the COM Jacobians, Mq and gen_Mx results are reused across ticks while q stays
+        # in the same cell of a grid with spacing cache_res, see lrucache.LruCache
+        self.cache = None
+        self.cache_entry = None  # cache entry of this tick
+        if cache_size > 0:
+            if symbolic is True or urdf is not None:
+                raise ValueError("the dynamics cache only applies to the hand-derived model")
+            self.cache = lrucache.LruCache(size=cache_size, res=cache_res)
+
+    def trig(self, q=None):
+        """
+        Sines and cosines of q0, q1, q1 + q2 and q1 + q2 + q3, the only trig terms the kinematics use.
+        q can also be an (N, 4) array of configurations, every kinematics function then returns N results
+        stacked along a new first axis, e.g. (N, 6, 4) Jacobians.
+        """
+        q = np.asarray(self.q if q is None else q)
+        q0 = q[..., 0]
+        q1 = q[..., 1]
+        q12 = q1 + q[..., 2]
+        a = np.array([q0, q1, q12, q12 + q[..., 3]])  # (4,) or (4, N)
+        return np.sin(a), np.cos(a)
+
+    def gen_jacCOM0(self, q=None, tr=None, out=None):
         """Generates the Jacobian from the COM of the first
         link to the origin frame"""
-        q = self.q if q is None else q
-        q0 = q[0]
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         l0 = self.coml[0]
 
-        JCOM0 = np.zeros((6, 4))
-        JCOM0[1, 0] = -l0*np.sin(q0)
-        JCOM0[2, 0] = l0*np.cos(q0)
-        JCOM0[3, 0] = 1
+        JCOM0 = np.zeros(np.shape(s0) + (6, 4)) if out is None else out
+        JCOM0.fill(0)
+        JCOM0[..., 1, 0] = -l0*s0
+        JCOM0[..., 2, 0] = l0*c0
+        JCOM0[..., 3, 0] = 1
 
         return JCOM0
 
-    def gen_jacCOM1(self, q=None):
+    def gen_jacCOM1(self, q=None, tr=None, out=None):
         """Generates the Jacobian from the COM of the first
         link to the origin frame"""
-        q = self.q if q is None else q
-        q0 = q[0]
-        q1 = q[1]
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         L0 = self.L[0]
 
         l1 = self.coml[1]
 
-        JCOM1 = np.zeros((6, 4))
-        JCOM1[0, 1] = -l1*np.cos(q1)
-        JCOM1[1, 0] = -(L0 + l1*np.cos(q1))*np.sin(q0)
-        JCOM1[1, 1] = -l1*np.sin(q1)*np.cos(q0)
-        JCOM1[2, 0] = (L0 + l1*np.cos(q1))*np.cos(q0)
-        JCOM1[2, 1] = -l1*np.sin(q0)*np.sin(q1)
-        JCOM1[3, 0] = 1
-        JCOM1[5, 1] = 1
+        JCOM1 = np.zeros(np.shape(s0) + (6, 4)) if out is None else out
+        JCOM1.fill(0)
+        JCOM1[..., 0, 1] = -l1*c1
+        JCOM1[..., 1, 0] = -(L0 + l1*c1)*s0
+        JCOM1[..., 1, 1] = -l1*s1*c0
+        JCOM1[..., 2, 0] = (L0 + l1*c1)*c0
+        JCOM1[..., 2, 1] = -l1*s0*s1
+        JCOM1[..., 3, 0] = 1
+        JCOM1[..., 5, 1] = 1
 
         return JCOM1
 
-    def gen_jacCOM2(self, q=None):
+    def gen_jacCOM2(self, q=None, tr=None, out=None):
         """Generates the Jacobian from the COM of the third
         link to the origin frame"""
-        q = self.q if q is None else q
-
-        q0 = q[0]
-        q1 = q[1]
-        q2 = q[2]
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         L0 = self.L[0]
         L1 = self.L[1]
 
         l2 = self.coml[2]
 
-        JCOM2 = np.zeros((6, 4))
-        JCOM2[0, 1] = -L1*np.cos(q1) - l2*np.cos(q1 + q2)
-        JCOM2[0, 2] = -l2*np.cos(q1 + q2)
-        JCOM2[1, 0] = -(L0 + L1*np.cos(q1) + l2*np.cos(q1 + q2))*np.sin(q0)
-        JCOM2[1, 1] = -(L1*np.sin(q1) + l2*np.sin(q1 + q2))*np.cos(q0)
-        JCOM2[1, 2] = -l2*np.sin(q1 + q2)*np.cos(q0)
-        JCOM2[2, 0] = (L0 + L1*np.cos(q1) + l2*np.cos(q1 + q2))*np.cos(q0)
-        JCOM2[2, 1] = -(L1*np.sin(q1) + l2*np.sin(q1 + q2))*np.sin(q0)
-        JCOM2[2, 2] = -l2*np.sin(q0)*np.sin(q1 + q2)
-        JCOM2[3, 0] = 1
-        JCOM2[5, 1] = 1
-        JCOM2[5, 2] = 1
+        JCOM2 = np.zeros(np.shape(s0) + (6, 4)) if out is None else out
+        JCOM2.fill(0)
+        JCOM2[..., 0, 1] = -L1*c1 - l2*c12
+        JCOM2[..., 0, 2] = -l2*c12
+        JCOM2[..., 1, 0] = -(L0 + L1*c1 + l2*c12)*s0
+        JCOM2[..., 1, 1] = -(L1*s1 + l2*s12)*c0
+        JCOM2[..., 1, 2] = -l2*s12*c0
+        JCOM2[..., 2, 0] = (L0 + L1*c1 + l2*c12)*c0
+        JCOM2[..., 2, 1] = -(L1*s1 + l2*s12)*s0
+        JCOM2[..., 2, 2] = -l2*s0*s12
+        JCOM2[..., 3, 0] = 1
+        JCOM2[..., 5, 1] = 1
+        JCOM2[..., 5, 2] = 1
 
         return JCOM2
 
-    def gen_jacCOM3(self, q=None):
+    def gen_jacCOM3(self, q=None, tr=None, out=None):
         """Generates the Jacobian from the COM of the fourth
         link to the origin frame"""
-        q = self.q if q is None else q
-
-        q0 = q[0]
-        q1 = q[1]
-        q2 = q[2]
-        q3 = q[3]
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         L0 = self.L[0]
         L1 = self.L[1]
@@ -206,189 +258,265 @@ class Leg(LegBase):
 
         l3 = self.coml[3]
 
-        JCOM3 = np.zeros((6, 4))
-        JCOM3[0, 1] = -L1*np.cos(q1) - L2*np.cos(q1 + q2) - l3*np.cos(q1 + q2 + q3)
-        JCOM3[0, 2] = -L2*np.cos(q1 + q2) - l3*np.cos(q1 + q2 + q3)
-        JCOM3[0, 3] = -l3*np.cos(q1 + q2 + q3)
-        JCOM3[1, 0] = -(L0 + L1*np.cos(q1) + L2*np.cos(q1 + q2) + l3*np.cos(q1 + q2 + q3))*np.sin(q0)
-        JCOM3[1, 1] = -(L1*np.sin(q1) + L2*np.sin(q1 + q2) + l3*np.sin(q1 + q2 + q3))*np.cos(q0)
-        JCOM3[1, 2] = -(L2*np.sin(q1 + q2) + l3*np.sin(q1 + q2 + q3))*np.cos(q0)
-        JCOM3[1, 3] = -l3*np.sin(q1 + q2 + q3)*np.cos(q0)
-        JCOM3[2, 0] = (L0 + L1*np.cos(q1) + L2*np.cos(q1 + q2) + l3*np.cos(q1 + q2 + q3))*np.cos(q0)
-        JCOM3[2, 1] = -(L1*np.sin(q1) + L2*np.sin(q1 + q2) + l3*np.sin(q1 + q2 + q3))*np.sin(q0)
-        JCOM3[2, 2] = -(L2*np.sin(q1 + q2) + l3*np.sin(q1 + q2 + q3))*np.sin(q0)
-        JCOM3[2, 3] = -l3*np.sin(q0)*np.sin(q1 + q2 + q3)
-        JCOM3[3, 0] = 1
-        JCOM3[5, 1] = 1
-        JCOM3[5, 2] = 1
-        JCOM3[5, 3] = 1
+        JCOM3 = np.zeros(np.shape(s0) + (6, 4)) if out is None else out
+        JCOM3.fill(0)
+        JCOM3[..., 0, 1] = -L1*c1 - L2*c12 - l3*c123
+        JCOM3[..., 0, 2] = -L2*c12 - l3*c123
+        JCOM3[..., 0, 3] = -l3*c123
+        JCOM3[..., 1, 0] = -(L0 + L1*c1 + L2*c12 + l3*c123)*s0
+        JCOM3[..., 1, 1] = -(L1*s1 + L2*s12 + l3*s123)*c0
+        JCOM3[..., 1, 2] = -(L2*s12 + l3*s123)*c0
+        JCOM3[..., 1, 3] = -l3*s123*c0
+        JCOM3[..., 2, 0] = (L0 + L1*c1 + L2*c12 + l3*c123)*c0
+        JCOM3[..., 2, 1] = -(L1*s1 + L2*s12 + l3*s123)*s0
+        JCOM3[..., 2, 2] = -(L2*s12 + l3*s123)*s0
+        JCOM3[..., 2, 3] = -l3*s0*s123
+        JCOM3[..., 3, 0] = 1
+        JCOM3[..., 5, 1] = 1
+        JCOM3[..., 5, 2] = 1
+        JCOM3[..., 5, 3] = 1
 
         return JCOM3
 
-    def gen_jacEE(self, q=None):
+    def gen_jacEE(self, q=None, tr=None, out=None):
         """Generates the Jacobian from the end effector to the origin frame"""
-        q = self.q if q is None else q
-
-        q0 = q[0]
-        q1 = q[1]
-        q2 = q[2]
-        q3 = q[3]
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         L0 = self.L[0]
         L1 = self.L[1]
         L2 = self.L[2]
         L3 = self.L[3]
 
-        JEE = np.zeros((6, 4))  # (3, 4) if only x, y, z forces controlled, others dropped
-        JEE[0, 1] = -L1*np.cos(q1) - L2*np.cos(q1 + q2) - L3*np.cos(q1 + q2 + q3)
-        JEE[0, 2] = -L2*np.cos(q1 + q2) - L3*np.cos(q1 + q2 + q3)
-        JEE[0, 3] = -L3*np.cos(q1 + q2 + q3)
-        JEE[1, 0] = -(L0 + L1*np.cos(q1) + L2*np.cos(q1 + q2) + L3*np.cos(q1 + q2 + q3))*np.sin(q0)
-        JEE[1, 1] = -(L1*np.sin(q1) + L2*np.sin(q1 + q2) + L3*np.sin(q1 + q2 + q3))*np.cos(q0)
-        JEE[1, 2] = -(L2*np.sin(q1 + q2) + L3*np.sin(q1 + q2 + q3))*np.cos(q0)
-        JEE[1, 3] = -L3*np.sin(q1 + q2 + q3)*np.cos(q0)
-        JEE[2, 0] = (L0 + L1*np.cos(q1) + L2*np.cos(q1 + q2) + L3*np.cos(q1 + q2 + q3))*np.cos(q0)
-        JEE[2, 1] = -(L1*np.sin(q1) + L2*np.sin(q1 + q2) + L3*np.sin(q1 + q2 + q3))*np.sin(q0)
-        JEE[2, 2] = -(L2*np.sin(q1 + q2) + L3*np.sin(q1 + q2 + q3))*np.sin(q0)
-        JEE[2, 3] = -L3*np.sin(q0)*np.sin(q1 + q2 + q3)
-        JEE[3, 0] = 1
-        JEE[5, 1] = 1
-        JEE[5, 2] = 1
-        JEE[5, 3] = 1
+        JEE = np.zeros(np.shape(s0) + (6, 4)) if out is None else out  # (3, 4) if only x, y, z forces controlled
+        JEE.fill(0)
+        JEE[..., 0, 1] = -L1*c1 - L2*c12 - L3*c123
+        JEE[..., 0, 2] = -L2*c12 - L3*c123
+        JEE[..., 0, 3] = -L3*c123
+        JEE[..., 1, 0] = -(L0 + L1*c1 + L2*c12 + L3*c123)*s0
+        JEE[..., 1, 1] = -(L1*s1 + L2*s12 + L3*s123)*c0
+        JEE[..., 1, 2] = -(L2*s12 + L3*s123)*c0
+        JEE[..., 1, 3] = -L3*s123*c0
+        JEE[..., 2, 0] = (L0 + L1*c1 + L2*c12 + L3*c123)*c0
+        JEE[..., 2, 1] = -(L1*s1 + L2*s12 + L3*s123)*s0
+        JEE[..., 2, 2] = -(L2*s12 + L3*s123)*s0
+        JEE[..., 2, 3] = -L3*s0*s123
+        JEE[..., 3, 0] = 1
+        JEE[..., 5, 1] = 1
+        JEE[..., 5, 2] = 1
+        JEE[..., 5, 3] = 1
 
         return JEE
 
-    def gen_Mq(self, q=None):
-        # Mass matrix
-        M0 = self.MM[0]
-        M1 = self.MM[1]
-        M2 = self.MM[2]
-        M3 = self.MM[3]
-
-        JCOM0 = self.gen_jacCOM0(q=q)
-        JCOM1 = self.gen_jacCOM1(q=q)
-        JCOM2 = self.gen_jacCOM2(q=q)
-        JCOM3 = self.gen_jacCOM3(q=q)
+    def gen_jacCOM(self, q=None, tr=None, out=None):
+        # COM Jacobians of all four links
+        tr = self.trig(q) if tr is None else tr
+        out = [None] * 4 if out is None else out
+        return [self.gen_jacCOM0(tr=tr, out=out[0]), self.gen_jacCOM1(tr=tr, out=out[1]),
+                self.gen_jacCOM2(tr=tr, out=out[2]), self.gen_jacCOM3(tr=tr, out=out[3])]
 
-        Mq = (np.dot(JCOM0.T, np.dot(M0, JCOM0)) +
-              np.dot(JCOM1.T, np.dot(M1, JCOM1)) +
-              np.dot(JCOM2.T, np.dot(M2, JCOM2)) +
-              np.dot(JCOM3.T, np.dot(M3, JCOM3)))
+    def gen_Mq(self, q=None, JCOM=None, out=None):
+        # Mass matrix
+        if JCOM is None:
+            JCOM = self.gen_jacCOM(q=q)
+
+        Mq = np.zeros(np.shape(JCOM[0])[:-2] + (4, 4)) if out is None else out
+        Mq.fill(0)
+        for M, J in zip(self.MM, JCOM):
+            if np.ndim(J) == 2:
+                np.dot(M, J, out=self.MJ)
+                np.dot(J.T, self.MJ, out=self.JMJ)
+                Mq += self.JMJ
+            else:
+                Mq += np.matmul(np.swapaxes(J, -1, -2), np.matmul(M, J))
 
         return Mq
 
-    def gen_grav(self, b_orient, q=None):
-        # Generate gravity term g(q)
-        body_grav = np.dot(b_orient.T, self.gravity)  # adjust gravity vector based on body orientation
-        body_grav = np.append(body_grav, np.array([[0, 0, 0]]).T)
-        for i in range(0, 4):
-            fgi = float(self.mass[i])*body_grav  # apply mass*gravity
-            self.Fg.append(fgi)
-
-        J0T = np.transpose(self.gen_jacCOM0(q=q))
-        J1T = np.transpose(self.gen_jacCOM1(q=q))
-        J2T = np.transpose(self.gen_jacCOM2(q=q))
-        J3T = np.transpose(self.gen_jacCOM3(q=q))
-
-        gq = J0T.dot(self.Fg[0]) + J1T.dot(self.Fg[1]) + J2T.dot(self.Fg[2]) + J3T.dot(self.Fg[3])
+    def gen_Mx(self, JEE=None, q=None, Mq=None, rows=None, **kwargs):
+        # LegBase.gen_Mx, memoized in this tick's cache entry for the snapshot Mq
+        # rows says which rows of the snapshot JEE were passed in, and is the memo key
+        entry = self.cache_entry
+        if entry is None or rows is None or q is not None or JEE is None or Mq is not self.Mq:
+            return LegBase.gen_Mx(self, JEE=JEE, q=q, Mq=Mq, **kwargs)
+        key = tuple(np.arange(6)[rows])
+        cached = entry['Mx'].get(key)
+        if cached is None:
+            Mx = LegBase.gen_Mx(self, JEE=JEE, Mq=Mq)
+            entry['Mx'][key] = (Mx, self.Mq_chol, self.Mq_chol_JT, self.Mq_inv_JT)
+            return Mx
+        Mx, self.Mq_chol, self.Mq_chol_JT, self.Mq_inv_JT = cached
+        return Mx
+
+    def gen_grav(self, b_orient, q=None, out=None):
+        # Generate gravity term g(q), from the current body orientation every call
+        gq = np.zeros(4) if out is None else out
+
+        np.dot(b_orient.T, self.gravity[:, 0], out=self.body_grav)  # adjust gravity vector based on body orientation
+        np.multiply(self.mass[0:4, None], self.body_grav, out=self.Fg[:, 0:3])  # apply mass*gravity
+        if q is None and self.model is not None:
+            return np.dot(self.model.blocks['Gm'].T, self.body_grav, out=gq)
+
+        # sum of JCOM_i.T*Fg_i, for the URDF model the same as -rnea(q, 0, 0, gravity) as its COM Jacobians are exact
+        JCOM = self.JCOM if q is None else self.gen_jacCOM(q=q)  # this tick's snapshot unless q is given
+        return np.dot(self.Fg.reshape(24), np.concatenate(JCOM), out=gq)
+
+    def inv_kinematics(self, xyz, phi=0):
+        """
+        Joint angles that put the end effector at xyz relative to base, with the toe at angle phi in the leg
+        plane (q1 + q2 + q3 = phi, 0 keeps it level like the wbc leveler) and the knee bent backwards.
+        xyz can also be an (N, 3) array of targets.
+        :return: (q, valid), q is (4,) or (N, 4). valid is False where the target is out of reach or needs
+        angles outside q_min, q_max; those rows hold the solution for the nearest stretched or folded leg.
+        """
+        xyz = np.asarray(xyz, dtype=float)
+        x = xyz[..., 0]
+        y = xyz[..., 1]
+        z = xyz[..., 2]
+        L0, L1, L2, L3 = self.L
+
+        q0 = np.arctan2(z, y)  # rotates the leg plane
+        r = np.sqrt(y**2 + z**2)
+        # two link problem in the leg plane, the toe is set by phi
+        u = -x - L3 * np.sin(phi)  # L1*s1 + L2*s12
+        v = r - L0 - L3 * np.cos(phi)  # L1*c1 + L2*c12
+        c2 = (u**2 + v**2 - L1**2 - L2**2) / (2 * L1 * L2)
+        q2 = -np.arccos(np.clip(c2, -1, 1))
+        q1 = np.arctan2(u, v) - np.arctan2(L2 * np.sin(q2), L1 + L2 * np.cos(q2))
+        q3 = phi - q1 - q2
+
+        q = np.stack([q0, q1, q2, q3], axis=-1)
+        tol = 1e-9  # so targets placed right at a joint limit by reach.Reach.clamp stay valid
+        valid = (np.abs(c2) <= 1) & np.all((q >= self.q_min - tol) & (q <= self.q_max + tol), axis=-1)
+        return q, valid
+
+    def position(self, q=None, tr=None):
+        """forward kinematics
+        Compute x,y,z position of end effector relative to base.
+        This outputs four sets of xyz values, one for each joint including the end effector.
 
-        return gq.reshape(-1, )
+        q np.array: a set of angles to return positions for
+        """
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
-    def inv_kinematics(self, xyz):
         L0 = self.L[0]
         L1 = self.L[1]
         L2 = self.L[2]
         L3 = self.L[3]
 
-        x = xyz[0]
-        # y = xyz[1]
-        z = xyz[2]
+        x = -np.cumsum([
+            0 * s1,  # femur
+            L1 * s1,
+            L2 * s12,
+            L3 * s123], axis=0)
 
-        d = np.sqrt(x**2 + (abs(z) - L0 - L3)**2)
-        q2 = np.pi/180 - np.arccos((-L1**2 - L2**2 + d**2)/(-2*L1*L2))
-        alpha = np.arccos((d**2 + L1**2 - L2**2)/(2*d*L1))
-        q1 = alpha - np.arcsin((x/d))
-        q0 = np.arcsin(z/(L0 + L1*np.cos(q1) + L2*np.cos(q1 + q2) + L3))
-        q3 = np.pi/180 - q1 - q2  # keep foot flat for now, simplifies kinematics
+        y = np.cumsum([
+            L0 * c0,
+            L1 * c1 * c0,
+            L2 * c12 * c0,
+            L3 * c123 * c0], axis=0)
 
-        return np.array([q0, q1, q2, q3], dtype=float)
+        z = np.cumsum([
+            L0 * s0,
+            L1 * c1 * s0,
+            L2 * c12 * s0,
+            L3 * c123 * s0], axis=0)
 
-    def position(self, q=None):
-        """forward kinematics
-        Compute x,y,z position of end effector relative to base.
-        This outputs four sets of xyz values, one for each joint including the end effector.
+        return batch_first(np.array([x, y, z], dtype=float))
 
-        q np.array: a set of angles to return positions for
+    def position_com(self, q=None, tr=None):
         """
-        if q is None:
-            q0 = self.q[0]
-            q1 = self.q[1]
-            q2 = self.q[2]
-            q3 = self.q[3]
-        else:
-            q0 = q[0]
-            q1 = q[1]
-            q2 = q[2]
-            q3 = q[3]
+        Compute x,y,z position of the COM of each link relative to base, the points gen_jacCOM0-3 are taken at.
+        Outputs one column per link, like position().
+        """
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
 
         L0 = self.L[0]
         L1 = self.L[1]
         L2 = self.L[2]
-        L3 = self.L[3]
+        l0, l1, l2, l3 = self.coml[0:4]
 
-        x = -np.cumsum([
-            0,  # femur
-            L1 * np.sin(q1),
-            L2 * np.sin(q1 + q2),
-            L3 * np.sin(q1 + q2 + q3)])
+        x = -np.array([
+            0 * s1,
+            l1 * s1,
+            L1 * s1 + l2 * s12,
+            L1 * s1 + L2 * s12 + l3 * s123])
 
-        y = np.cumsum([
-            L0 * np.cos(q0),
-            L1 * np.cos(q1) * np.cos(q0),
-            L2 * np.cos(q1 + q2) * np.cos(q0),
-            L3 * np.cos(q1 + q2 + q3) * np.cos(q0)])
+        r = np.array([
+            l0 + 0 * c1,
+            L0 + l1 * c1,
+            L0 + L1 * c1 + l2 * c12,
+            L0 + L1 * c1 + L2 * c12 + l3 * c123])
 
-        z = np.cumsum([
-            L0 * np.sin(q0),
-            L1 * np.cos(q1) * np.sin(q0),
-            L2 * np.cos(q1 + q2) * np.sin(q0),
-            L3 * np.cos(q1 + q2 + q3) * np.sin(q0)])
+        return batch_first(np.array([x, r * c0, r * s0], dtype=float))
 
-        return np.array([x, y, z], dtype=float)
+    def gen_Jdot(self, q=None, dq=None, tr=None, out=None):
+        """
+        Time derivatives of the COM Jacobians and the end effector Jacobian, stacked as (5, 6, 4) in the order
+        JCOM0-3, JEE. Their angular rows are constant, so only the linear rows are nonzero.
+        Uses the same trig terms as the Jacobians.
+        """
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
+        dq = self.dq if dq is None else dq
+        Jdot = np.zeros((5, 6, 4)) if out is None else out
+
+        w0 = dq[0]
+        w = np.dot(self.sum_lower, dq[1:4])  # rates of q1, q1 + q2 and q1 + q2 + q3
+        A = self.point_a
+        As = A * [s1, s12, s123]
+        Ac = A * [c1, c12, c123]
+        r = self.point_b + np.dot(Ac, self.ones3)
+        r_d = -np.dot(As, w)
+
+        # joint j >= 1 turns every angle from the j-th on: dx/dq_j = -sum(a*cos), dr/dq_j = -sum(a*sin)
+        S_j = np.dot(As, self.sum_upper)
+        C_j_d = -np.dot(As * w, self.sum_upper)
+        S_j_d = np.dot(Ac * w, self.sum_upper)
+
+        Jdot.fill(0)
+        Jdot[:, 1, 0] = -r_d * s0 - r * c0 * w0
+        Jdot[:, 2, 0] = r_d * c0 - r * s0 * w0
+        Jdot[:, 0, 1:4] = -C_j_d
+        Jdot[:, 1, 1:4] = S_j * (s0 * w0) - S_j_d * c0
+        Jdot[:, 2, 1:4] = -S_j_d * s0 - S_j * (c0 * w0)
+
+        return Jdot
 
     def velocity(self):  # dq=None
         # Calculate operational space linear velocity vector
         # if dq is None:
         #     dq = self.dq
-        JEE = self.gen_jacEE(q=q)
+        JEE = self.JEE
         return np.dot(JEE, self.dq).flatten()
 
-    def orientation(self, b_orient, q=None):
-        # Calculate orientation of end effector in quaternions
-        if q is None:
-            q0 = self.q[0]
-            q1 = self.q[1]
-            q2 = self.q[2]
-            q3 = self.q[3]
-        else:
-            q0 = q[0]
-            q1 = q[1]
-            q2 = q[2]
-            q3 = q[3]
-
-        REE = np.zeros((3, 3))  # rotation matrix
-        REE[0, 0] = np.cos(q1 + q2 + q3)
-        REE[0, 1] = -np.sin(q1 + q2 + q3)
-        REE[1, 0] = np.sin(q1 + q2 + q3)*np.cos(q0)
-        REE[1, 1] = np.cos(q0)*np.cos(q1 + q2 + q3)
-        REE[1, 2] = -np.sin(q0)
-        REE[2, 0] = np.sin(q0)*np.sin(q1 + q2 + q3)
-        REE[2, 1] = np.sin(q0)*np.cos(q1 + q2 + q3)
-        REE[2, 2] = np.cos(q0)
+    def rotation(self, q=None, tr=None):
+        # rotation matrix of the end effector relative to base
+        (s0, s1, s12, s123), (c0, c1, c12, c123) = self.trig(q) if tr is None else tr
+
+        REE = np.zeros(np.shape(s0) + (3, 3))  # rotation matrix
+        REE[..., 0, 0] = c123
+        REE[..., 0, 1] = -s123
+        REE[..., 1, 0] = s123*c0
+        REE[..., 1, 1] = c0*c123
+        REE[..., 1, 2] = -s0
+        REE[..., 2, 0] = s0*s123
+        REE[..., 2, 1] = s0*c123
+        REE[..., 2, 2] = c0
         # REE[3, 3] = 1
-        REE = np.dot(b_orient, REE)
-        q_e = transforms3d.quaternions.mat2quat(REE)
-        q_e = q_e / np.linalg.norm(q_e)  # convert to unit vector quaternion
+
+        return REE
+
+    def orientation(self, b_orient, q=None, out=None):
+        # Calculate orientation of end effector in quaternions
+        if q is None:  # this tick's snapshot, a single quaternion
+            if self.tree is not None:
+                return quat.from_mat(np.dot(b_orient, self.REE), out=out)
+            # REE = Rx(q0)*Rz(q1 + q2 + q3), see rotation()
+            q_ee = quat.rx_rz(self.q[0], self.q[1] + self.q[2] + self.q[3], out=self.q_ee)
+            q_e = quat.mult(quat.from_mat(b_orient, out=self.q_b), q_ee, out=out)
+            if q_e[0] < 0:  # same sign as mat2quat
+                np.negative(q_e, out=q_e)
+            return q_e
+        REE = np.matmul(b_orient, self.rotation(q=q))
+        q_e = mat2quat(REE)  # unit quaternion(s)
 
         return q_e
 
@@ -421,3 +549,115 @@ class Leg(LegBase):
         self.q_previous = self.q
         self.dq_previous = self.dq
         self.d2q_previous = self.d2q
+
+        self.update_kinematics()
+        self.update_dynamics()
+
+    def update_kinematics(self):
+        """
+        Kinematic snapshot at the current q, computed once per tick by update_state.
+        Controllers read these instead of calling the gen_* functions again.
+        """
+        if self.model is not None:
+            blocks = self.model.eval(self.q)
+            self.tr = None
+            self.pos = np.array(blocks['pos'])
+            self.x_ee = self.pos[:, -1]  # end effector position relative to base
+            self.pos_com = np.array(blocks['pos_com'])
+            self.REE = np.array(blocks['REE'])
+            return
+
+        if self.tree is not None:
+            tree = self.tree
+            np.multiply(self.q_sign, self.q - q_urdf_zero, out=self.q_tree)
+            tree.update(self.q_tree)
+            hip = tree.p[0][:, None]
+            self.pos = np.column_stack([tree.p[1], tree.p[2], tree.p[3], tree.point(3, self.tip)]) - hip
+            self.x_ee = self.pos[:, -1]  # end effector position relative to base
+            self.pos_com = np.column_stack([tree.point(i, tree.com[i]) for i in range(4)]) - hip
+            for i in range(4):
+                tree.jacobian(i, tree.com[i], out=self.JCOM[i])
+                self.JCOM[i] *= self.q_sign
+            tree.jacobian(3, self.tip, out=self.JEE)
+            self.JEE *= self.q_sign
+            tree.crba(self.q_tree, out=self.Mq)
+            self.Mq *= self.Mq_sign
+            self.REE = np.dot(tree.R[3], self.R_tip)
+            self.tr = None
+            return
+
+        tr = self.trig()
+        self.tr = tr
+        entry = None
+        if self.cache is not None:
+            key = self.cache.key(self.q)
+            entry = self.cache.get(key)
+            if entry is not None:
+                for J, J_cached in zip(self.JCOM, entry['JCOM']):
+                    np.copyto(J, J_cached)
+                np.copyto(self.Mq, entry['Mq'])
+                if self.cache.due():
+                    self.cache.verify(self.Mq, self.gen_Mq(q=self.q))
+        if entry is None:
+            self.gen_jacCOM(tr=tr, out=self.JCOM)
+            self.gen_Mq(JCOM=self.JCOM, out=self.Mq)
+            if self.cache is not None:
+                entry = {'JCOM': [np.copy(J) for J in self.JCOM], 'Mq': np.copy(self.Mq), 'Mx': {}}
+                self.cache.put(key, entry)
+        self.cache_entry = entry
+        self.gen_jacEE(tr=tr, out=self.JEE)
+        self.pos = self.position(tr=tr)
+        self.x_ee = self.pos[:, -1]  # end effector position relative to base
+        self.pos_com = self.position_com(tr=tr)
+        self.REE = self.rotation(tr=tr)
+
+    def update_dynamics(self):
+        """
+        Velocity product terms at the current q and dq, computed once per tick by update_state after the
+        kinematic snapshot. With only the linear rows of the Jacobians depending on q, C(q, dq)*dq is
+        sum(m_i*JCOM_i.T*JCOM_i_dot*dq) and C(q, dq).T*dq is sum(m_i*JCOM_i_dot.T*JCOM_i*dq).
+        """
+        if self.tree is not None:
+            # C(q, dq)*dq and JEE_dot*dq by Newton-Euler, C(q, dq).T*dq as the kinetic energy gradient
+            tree = self.tree
+            np.multiply(self.q_sign, self.dq, out=self.dq_tree)
+            tree.rnea(self.q_tree, self.dq_tree, self.ddq_tree, out=self.Cdq)
+            self.Cdq *= self.q_sign
+            tree.point_acceleration(3, self.tip, out=self.JEEdot_dq)  # before ctdq, which reuses tree.v
+            tree.ctdq(self.q_tree, self.dq_tree, out=self.CTdq)
+            self.CTdq *= self.q_sign
+            return
+
+        Jdot = self.gen_Jdot(tr=self.trig() if self.tr is None else self.tr, out=self.Jdot)
+        np.dot(Jdot[4], self.dq, out=self.JEEdot_dq)
+        J = np.array(self.JCOM)[:, 0:3]
+        J_d = Jdot[0:4, 0:3]
+        ma = self.mass[0:4, None] * np.dot(J_d, self.dq)  # m_i*JCOM_i_dot*dq
+        mv = self.mass[0:4, None] * np.dot(J, self.dq)  # m_i*JCOM_i*dq
+        np.dot(J.reshape(12, 4).T, ma.reshape(12), out=self.Cdq)
+        np.dot(J_d.reshape(12, 4).T, mv.reshape(12), out=self.CTdq)
+
+
+def batch_first(a):
+    # (3, 4, N) stacked kinematics to (N, 3, 4), single results are left as they are
+    return a if a.ndim < 3 else np.moveaxis(a, -1, 0)
+
+
+def mat2quat(R):
+    """
+    Rotation matrices (..., 3, 3) to unit quaternions (..., 4) [w, x, y, z] with w >= 0, like
+    transforms3d.quaternions.mat2quat but vectorized. Shepperd's method: each of the four forms is 4*q_k*q,
+    use the one with the largest q_k for accuracy.
+    """
+    R = np.asarray(R)
+    r00, r01, r02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+    r10, r11, r12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+    r20, r21, r22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+    forms = np.array([[1 + r00 + r11 + r22, r21 - r12, r02 - r20, r10 - r01],
+                      [r21 - r12, 1 + r00 - r11 - r22, r01 + r10, r02 + r20],
+                      [r02 - r20, r01 + r10, 1 - r00 + r11 - r22, r12 + r21],
+                      [r10 - r01, r02 + r20, r12 + r21, 1 - r00 - r11 + r22]])  # (4, 4, ...)
+    k = np.argmax(np.array([forms[0, 0], forms[1, 1], forms[2, 2], forms[3, 3]]), axis=0)
+    q = np.moveaxis(np.take_along_axis(forms, k[None, None], axis=0)[0], 0, -1)
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    return np.where(q[..., 0:1] < 0, -q, q)
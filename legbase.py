@@ -27,6 +27,9 @@ class LegBase:
         self.dt = dt
         self.options = options
         self.singularity_thresh = singularity_thresh
+        self.Mq_chol = None  # Cholesky factor of Mq from the last gen_Mx
+        self.Mq_chol_JT = None  # Mq_chol^-1 * JEE.T from the last gen_Mx
+        self.Mq_inv_JT = None  # Mq^-1 * JEE.T from the last gen_Mx
 
         self.init_q = np.zeros(self.DOF) if init_q is None else init_q
         self.init_dq = np.zeros(self.DOF) if init_dq is None else init_dq
@@ -59,16 +62,34 @@ class LegBase:
 
         if JEE is None:
             JEE = self.gen_jacEE(q=q)
-        Mx_inv = np.dot(JEE, np.dot(np.linalg.inv(Mq), JEE.T))
-        u, s, v = np.linalg.svd(Mx_inv)
-        # cut off any singular values that could cause control problems
-        for i in range(len(s)):
-            s[i] = 0 if s[i] < self.singularity_thresh else 1. / float(s[i])
-        # numpy returns U,S,V.T, so have to transpose both here
-        Mx = np.dot(v.T, np.dot(np.diag(s), u.T))
+        # Mq = L*L.T, then Mx_inv = (L^-1*JEE.T).T*(L^-1*JEE.T) is symmetric by construction
+        try:
+            self.Mq_chol = np.linalg.cholesky(Mq)
+            self.Mq_chol_JT = np.linalg.solve(self.Mq_chol, JEE.T)
+            self.Mq_inv_JT = None  # only solved for if gen_Jdyn_inv asks
+            Mx_inv = np.dot(self.Mq_chol_JT.T, self.Mq_chol_JT)
+        except np.linalg.LinAlgError:  # Mq not positive definite
+            self.Mq_chol = None
+            self.Mq_chol_JT = None
+            self.Mq_inv_JT = np.dot(np.linalg.pinv(Mq), JEE.T)
+            Mx_inv = np.dot(JEE, self.Mq_inv_JT)
+            Mx_inv = (Mx_inv + Mx_inv.T) / 2
+
+        # cut off any eigenvalues that could cause control problems
+        Mx = inv3(Mx_inv, self.singularity_thresh) if len(Mx_inv) == 3 else None
+        if Mx is None:
+            w, v = np.linalg.eigh(Mx_inv)
+            w_inv = np.divide(1., w, out=np.zeros_like(w), where=w >= self.singularity_thresh)
+            Mx = np.dot(v * w_inv, v.T)
 
         return Mx
 
+    def gen_Jdyn_inv(self, Mx):
+        # Mx*JEE*Mq^-1 for the JEE and Mq of the last gen_Mx, reusing its factorization
+        if self.Mq_inv_JT is None:
+            self.Mq_inv_JT = np.linalg.solve(self.Mq_chol.T, self.Mq_chol_JT)
+        return np.dot(Mx, self.Mq_inv_JT.T)
+
     def reset(self, q=[], dq=[]):
         # Resets the state of the leg
 
@@ -88,3 +109,26 @@ class LegBase:
     def update_state(self, q_in):
         # Update the state
         pass
+
+
+def inv3(A, thresh):
+    """
+    Inverse of a symmetric 3x3 matrix by its adjugate, if all its eigenvalues are at least thresh.
+    Returns None otherwise. A is positive definite if its leading minors are, and then its smallest
+    eigenvalue is at least det / (trace / 2)^2, which is a cheap sufficient test.
+    """
+    (a, b, c), (_, d, e), (_, _, f) = A.tolist()
+    c00 = d * f - e * e
+    c01 = c * e - b * f
+    c02 = b * e - c * d
+    det = a * c00 + b * c01 + c * c02
+    tr = a + d + f
+    if a <= 0 or a * d - b * b <= 0 or det <= 0 or det * 4 < thresh * tr * tr:
+        return None
+    det = 1. / det
+    c11 = a * f - c * c
+    c12 = b * c - a * e
+    c22 = a * d - b * b
+    return np.array([[c00 * det, c01 * det, c02 * det],
+                     [c01 * det, c11 * det, c12 * det],
+                     [c02 * det, c12 * det, c22 * det]])
@@ -0,0 +1,144 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Leg kinematics and dynamics derived symbolically from the transform chain in math/spryped_jacobian.m,
+instead of copying the resulting formulas by hand.
+"""
+
+import numpy as np
+
+import casadi as cs
+
+import codegen
+
+# name and shape of each block of the model output, in order
+blocks = [('pos', (3, 4)),  # joint and end effector positions, as Leg.position()
+          ('pos_com', (3, 4)),  # link COM positions, as Leg.position_com()
+          ('JCOM0', (6, 4)),  # COM Jacobians, as Leg.gen_jacCOM0-3
+          ('JCOM1', (6, 4)),
+          ('JCOM2', (6, 4)),
+          ('JCOM3', (6, 4)),
+          ('JEE', (6, 4)),  # end effector Jacobian, as Leg.gen_jacEE
+          ('REE', (3, 3)),  # end effector rotation, as Leg.rotation
+          ('Mq', (4, 4)),  # joint space mass matrix, as Leg.gen_Mq
+          ('Gm', (3, 4))]  # sum of m_i*JCOM_i[0:3], gen_grav is Gm.T*body_grav
+
+
+def rot_x(a):
+    return cs.vertcat(cs.horzcat(1, 0, 0), cs.horzcat(0, cs.cos(a), -cs.sin(a)), cs.horzcat(0, cs.sin(a), cs.cos(a)))
+
+
+def rot_z(a):
+    return cs.vertcat(cs.horzcat(cs.cos(a), -cs.sin(a), 0), cs.horzcat(cs.sin(a), cs.cos(a), 0), cs.horzcat(0, 0, 1))
+
+
+def transform(R, p):
+    # homogeneous transform from a rotation and a translation
+    return cs.vertcat(cs.horzcat(R, p), cs.horzcat(0, 0, 0, 1))
+
+
+def point(T, p):
+    # position of point p, given in the frame of T
+    return cs.mtimes(T, cs.vertcat(p, 1))[0:3]
+
+
+def gen_model(L, coml, MM):
+    """
+    Builds the Function leg_model(q) -> one column holding every block in blocks, column-major.
+    The transforms, COM points and the angular rows of the Jacobians follow math/spryped_jacobian.m,
+    the mass matrix is the closed form of sum(J_i.T*M_i*J_i).
+    :param L: link lengths
+    :param coml: distance along each link to its COM
+    :param MM: 6x6 spatial mass matrix of each link
+    """
+    q = cs.SX.sym('q', 4)
+    q0, q1, q2, q3 = cs.vertsplit(q)
+    L0, L1, L2, L3 = [float(x) for x in L]
+    l0, l1, l2, l3 = [float(x) for x in coml]
+
+    Torg0 = transform(rot_x(q0), cs.vertcat(0, L0 * cs.cos(q0), L0 * cs.sin(q0)))
+    T01 = transform(rot_z(q1), cs.vertcat(-L1 * cs.sin(q1), L1 * cs.cos(q1), 0))
+    T12 = transform(rot_z(q2), cs.vertcat(-L2 * cs.sin(q2), L2 * cs.cos(q2), 0))
+    T23 = transform(rot_z(q3), cs.vertcat(-L3 * cs.sin(q3), L3 * cs.cos(q3), 0))
+    Torg1 = cs.mtimes(Torg0, T01)
+    Torg2 = cs.mtimes(Torg1, T12)
+    Torg3 = cs.mtimes(Torg2, T23)
+
+    origin = cs.DM.zeros(3)
+    pos = cs.horzcat(point(Torg0, origin), point(Torg1, origin), point(Torg2, origin), point(Torg3, origin))
+
+    com = [cs.vertcat(0, l0 * cs.cos(q0), l0 * cs.sin(q0)),  # com0 is already in the origin frame
+           point(Torg0, cs.vertcat(-l1 * cs.sin(q1), l1 * cs.cos(q1), 0)),
+           point(Torg1, cs.vertcat(-l2 * cs.sin(q2), l2 * cs.cos(q2), 0)),
+           point(Torg2, cs.vertcat(-l3 * cs.sin(q3), l3 * cs.cos(q3), 0))]
+    pos_com = cs.horzcat(*com)
+
+    def jacobian(p, n):
+        # linear rows from the point, angular rows as set in spryped_jacobian.m: q0 about x, q1..q(n-1) about z
+        J = cs.SX.zeros(6, 4)
+        J[0:3, :] = cs.jacobian(p, q)
+        J[3, 0] = 1
+        for k in range(1, n):
+            J[5, k] = 1
+        return J
+
+    JCOM = [jacobian(com[i], i + 1) for i in range(4)]
+    JEE = jacobian(point(Torg3, origin), 4)
+    REE = Torg3[0:3, 0:3]
+
+    Mq = cs.SX.zeros(4, 4)
+    Gm = cs.SX.zeros(3, 4)
+    for M, J in zip(MM, JCOM):
+        Mq += cs.mtimes([J.T, cs.DM(M), J])
+        Gm += M[0, 0] * J[0:3, :]
+
+    out = cs.vertcat(*[cs.vec(b) for b in [pos, pos_com] + JCOM + [JEE, REE, Mq, Gm]])
+    out = cs.cse(cs.simplify(out))  # merge the repeated sines, cosines and products
+    return cs.Function('leg_model', [q], [cs.densify(out)])  # dense, so the output maps onto a flat array
+
+
+def load(L, coml, MM):
+    # compiled and cached leg_model, see codegen.load
+    key = [np.asarray(L).tolist(), np.asarray(coml).tolist(), [np.asarray(M).tolist() for M in MM],
+           codegen.source_hash(__file__)]
+    return codegen.load('leg_model', key, lambda: gen_model(L, coml, MM))
+
+
+class LegModel:
+
+    def __init__(self, L, coml, MM):
+        """
+        Evaluates the compiled leg_model into one preallocated array. The blocks are views into it,
+        so they change in place with every call to eval.
+        """
+        self.fn = load(L, coml, MM)
+        self.q = np.zeros(4)
+        self.out = np.zeros(self.fn.size1_out(0))
+        self.buffer, self.call = self.fn.buffer()  # evaluates straight from and into the numpy arrays
+        self.buffer.set_arg(0, memoryview(self.q))
+        self.buffer.set_res(0, memoryview(self.out))
+
+        self.blocks = {}
+        i = 0
+        for name, shape in blocks:
+            n = shape[0] * shape[1]
+            self.blocks[name] = self.out[i:i + n].reshape(shape[::-1]).T  # column-major view
+            i += n
+
+    def eval(self, q):
+        self.q[:] = q
+        self.call()
+        return self.blocks
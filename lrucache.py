@@ -0,0 +1,78 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LruCache:
+
+    def __init__(self, size=256, res=1e-3, check=100, tol=1e-2):
+        """
+        Bounded least recently used cache keyed on joint configurations quantized to res (rad).
+        An entry is reused for every configuration in its cell, so cached values are off by up to what
+        a change of res in each joint does to them. Every check-th hit is due for verification against
+        a fresh computation, see due() and verify().
+        :param size: maximum number of entries, the least recently used one is evicted past it
+        :param tol: relative error past which verify() warns
+        """
+        self.size = size
+        self.res = res
+        self.check = check
+        self.tol = tol
+        self.entries = OrderedDict()
+        self.n_hit = 0
+        self.n_miss = 0
+        self.n_evict = 0
+        self.n_check = 0
+        self.err_max = 0  # largest relative error seen by verify()
+
+    def key(self, q):
+        return tuple(np.floor(np.asarray(q) / self.res + 0.5).astype(int).tolist())
+
+    def get(self, key):
+        # the entry for key, or None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.n_miss += 1
+            return None
+        self.entries.move_to_end(key)
+        self.n_hit += 1
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.n_evict += 1
+
+    def due(self):
+        # True if the entry returned by the last hit should be verified
+        return self.check > 0 and self.n_hit % self.check == 0
+
+    def verify(self, cached, exact):
+        # relative error of a cached value against a fresh one, warns past tol
+        err = np.max(np.abs(cached - exact)) / max(np.max(np.abs(exact)), 1e-12)
+        self.err_max = max(self.err_max, err)
+        self.n_check += 1
+        if err > self.tol:
+            print("WARNING: cached leg dynamics off by ", err, ", reduce the cache resolution")
+        return err
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,117 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Mass properties of the robot from the CAD exports in spryped_urdf_rev06, parsed once and kept
+as an .npz in codegen.cache_dir until one of the source files changes.
+"""
+import os
+import csv
+
+import numpy as np
+
+import codegen
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spryped_urdf_rev06')
+sources = {'left': 'spryped_data_left.csv',
+           'right': 'spryped_data_right.csv',
+           'urdf': os.path.join('urdf', 'spryped_urdf_rev06.csv'),
+           'body': 'spryped_data_body.csv'}
+
+_data = None  # loaded once per process
+
+
+def read_csv(name):
+    # header and rows of a CAD export, the body file starts with a byte order mark
+    with open(os.path.join(data_dir, sources[name]), 'r', encoding='utf-8-sig') as csvfile:
+        rows = list(csv.reader(csvfile, delimiter=','))
+    return rows[0], rows[1:]
+
+
+def parse():
+    """
+    :return: dict of arrays
+        left_inertia, right_inertia: Ixx, Ixy, Ixz, Iyy, Iyz, Izz of each leg link (4, 6)
+        left_coml, right_coml: distance along each leg link to its COM (4,)
+        urdf_names, urdf_mass, urdf_inertia: name, mass and Ixx..Izz of every URDF link, body first
+        urdf_com: COM of every URDF link in its own frame (n, 3)
+        urdf_joint_origin: origin of the joint of every URDF link in its parent's frame (n, 3), zero for the body
+        body_inertia: body inertia tensor in the local frame (3, 3)
+    """
+    data = {}
+    for side in ('left', 'right'):
+        header, rows = read_csv(side)
+        values = np.array([row[1:8] for row in rows], dtype=float)
+        data[side + '_inertia'] = values[:, 0:6]
+        data[side + '_coml'] = values[:, 6]
+
+    header, rows = read_csv('urdf')
+    data['urdf_names'] = np.array([row[0] for row in rows])
+    data['urdf_mass'] = np.array([row[7] for row in rows], dtype=float)
+    data['urdf_inertia'] = np.array([row[8:14] for row in rows], dtype=float)
+    com = header.index('Center of Mass X')
+    origin = header.index('Joint Origin X')
+    data['urdf_com'] = np.array([row[com:com + 3] for row in rows], dtype=float)
+    data['urdf_joint_origin'] = np.array([row[origin:origin + 3] for row in rows], dtype=float)
+
+    header, rows = read_csv('body')
+    body = dict(zip(header, np.array(rows[0], dtype=float)))
+    data['body_inertia'] = np.array([[body['ixx'], body['ixy'], body['ixz']],
+                                     [body['iyx'], body['iyy'], body['iyz']],
+                                     [body['izx'], body['izy'], body['izz']]])
+    return data
+
+
+def validate(data):
+    # link masses
+    mass = data['urdf_mass'][1:]  # remove body value
+    if mass[0] != mass[4]:
+        print("WARNING: femur L/R masses unequal, check CAD")
+    if mass[1] != mass[5]:
+        print("WARNING: tibiotarsus L/R masses unequal, check CAD")
+    if mass[2] != mass[6]:
+        print("WARNING: tarsometatarsus L/R masses unequal, check CAD")
+    if mass[3] != mass[7]:
+        print("WARNING: toe L/R masses unequal, check CAD")
+
+
+def load():
+    """
+    Parsed and validated model data, see parse(). The cache is keyed on the modification time and size
+    of each source file and on this file, so editing any of them triggers a fresh parse.
+    """
+    global _data
+    if _data is not None:
+        return _data
+
+    key = [codegen.source_hash(__file__)]
+    for name in sorted(sources):
+        st = os.stat(os.path.join(data_dir, sources[name]))
+        key.append((name, st.st_mtime_ns, st.st_size))
+    path = os.path.join(codegen.cache_dir, 'model_' + codegen.key_hash(key) + '.npz')
+
+    if os.path.isfile(path):
+        with np.load(path) as npz:
+            data = dict(npz)
+    else:
+        data = parse()
+        os.makedirs(codegen.cache_dir, exist_ok=True)
+        tmp = path + '.' + str(os.getpid()) + '.npz'  # so parallel runs don't collide
+        np.savez(tmp, **data)
+        os.replace(tmp, path)
+
+    validate(data)
+    _data = data
+    return data
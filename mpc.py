@@ -23,70 +23,261 @@ https://www.youtube.com/watch?v=RrnkPrcpyEA
 https://github.com/MMehrez/ ...Sim_3_MPC_Robot_PS_obs_avoid_mul_sh.m
 """
 
+import os
+import sys
 import time
+import ctypes
+import contextlib
 import numpy as np
 import numpy.matlib
 
-import csv
-import itertools
-
 import casadi as cs
 
+import codegen
+import modeldata
+
 
 class Mpc:
 
-    def __init__(self, **kwargs):
+    def __init__(self, warm_start=True, condensed=False, solver='qpoases', N=10, max_iter=None, rti=False,
+                 **kwargs):
 
         self.u = np.zeros((4, 1))  # control signal
         self.dt = 0.025  # sampling time (s)
-        self.N = 10  # prediction horizon
-        # horizon length = self.dt*self.N = .25 seconds
+        self.N = N  # prediction horizon
+        # horizon length = self.dt*self.N = .25 seconds by default
         self.mass = float(12.12427)  # kg
         self.mu = 0.5  # coefficient of friction
         self.b = 40 * np.pi / 180  # maximum kinematic leg angle
         self.fn = None
 
-        with open('spryped_urdf_rev06/spryped_data_body.csv', 'r') as csvfile:
-            data = csv.reader(csvfile, delimiter=',')
-            next(data)  # skip headers
-            values = list(zip(*(row for row in data)))  # transpose rows to columns
-            values = np.array(values)  # convert list of nested lists to array
-
-        ixx = values[1].astype(np.float)
-        ixy = values[2].astype(np.float)
-        ixz = values[3].astype(np.float)
-        iyy = values[4].astype(np.float)
-        iyz = values[5].astype(np.float)
-        izz = values[6].astype(np.float)
-
-        # m = np.zeros((6, 6))
-        # m[0:3, 0:3] = np.eye(3) * self.mass
-        i = np.zeros((3, 3))
-        i[0, 0] = ixx
-        i[0, 1] = ixy
-        i[0, 2] = ixz
-        i[1, 0] = ixy
-        i[1, 1] = iyy
-        i[1, 2] = iyz
-        i[2, 0] = ixz
-        i[2, 1] = iyz
-        i[2, 2] = izz
-        self.inertia = i  # inertia tensor in local frame
+        self.inertia = modeldata.load()['body_inertia']  # inertia tensor in local frame
 
         self.rh_r = np.array([.14397, .13519, .03581])  # vector from CoM to hip
         self.rh_l = np.array([-.14397, .13519, .03581])  # vector from CoM to hip
 
-    def mpcontrol(self, rz_phi, r1, r2, x_in, x_ref, c_l, c_r):  # p_l, p_r, c_l, c_r):
+        self.n_states = 12  # number of states
+        self.n_controls = 6  # number of controls
+        self.Q = np.eye(self.n_states) * 10  # state weighing matrix
+        self.R = np.eye(self.n_controls) * 10 / 2  # control weighing matrix
+        self.condensed = condensed  # eliminate the states and solve a small dense QP in the forces only
+        # real-time iteration: one QP per call on the full nonlinear dynamics, linearized along the previous
+        # solution. Needs the states as decision variables, so it can't be combined with condensed.
+        self.rti = rti
+        if rti is True and condensed is True:
+            raise ValueError("rti needs the sparse formulation, it can't be used with condensed=True")
+        # 'qpoases' (dense active set) or 'hpipm' (Riccati-based interior point, O(N) per iteration).
+        # For the horizons in benchmark.py mpc, condensed qpOASES is still the fastest
+        if solver == 'hpipm' and condensed is True:
+            raise ValueError("hpipm needs the stage-wise sparse formulation, it can't be used with condensed=True")
+        self.solver_name = solver
+        self.perm = None  # hpipm only: stage-wise variable order [x0 u0 x1 u1 ... xN] as indices into [X; U]
+        self.rows = None  # hpipm only: stage-wise constraint order [gap0 fc0 gap1 fc1 ...] as indices into g
+        self.st_len = 0  # number of state decision variables
+        self.dyn_len = 0  # number of IC + dynamics constraint rows
+        self.fc = None  # friction cone constraint matrix, condensed formulation only
+        # cap on solver iterations (qpOASES working set recalculations, hpipm iterations), None for no limit.
+        # Failed or cut off solves fall back to the last feasible plan. This bounds the work per solve, not its
+        # wall time: the qpOASES setup alone can outlast a control tick. See mpcworker.MpcWorker for a deadline.
+        self.max_iter = max_iter
+        self.t_plan = None  # last feasible plan
+        self.u_plan = None
+        self.n_fallback = 0  # number of calls that fell back to the last feasible plan
+        self.solver = None
+        self.lbx = None
+        self.ubx = None
+        self.lbg = None
+        self.ubg = None
+        self.build_qp()
+
+        # warm start: previous primal/dual solution, shifted one step forward in time before each solve.
+        # qpOASES itself hot starts from its last active set since the solver object is reused.
+        self.warm_start = warm_start
+        self.x_prev = None
+        self.lam_x_prev = None
+        self.lam_g_prev = None
+        self.iter_count = 0  # working set recalculations used by the last solve
+        self.iter_cold = None  # working set recalculations used by the first (cold) solve
+        # running total of iterations saved by warm starting, relative to the cold solve. Only counted with
+        # warm_start: qpOASES hot starts from its last working set either way, which isn't our doing
+        self.iter_saved = 0
+
+    def build_qp(self):
+        """
+        Builds the QP and its solver once. Everything that changes between calls (initial and reference
+        states, yaw rotation, inverse inertia and foot vectors) enters as a parameter, and contact
+        is applied through the bounds, so mpcontrol only has to update numbers and solve.
+        The dynamics and the QP matrices are compiled to C and cached on disk by codegen,
+        keyed on the model parameters, so later runs skip building the graph entirely.
+        """
+        key = [self.N, self.dt, self.mass, self.mu, self.inertia.tolist(), np.diag(self.Q).tolist(),
+               np.diag(self.R).tolist(), self.rti, codegen.source_hash(__file__)]
+        self.fn = codegen.load('fn', key, self.gen_fn)
+
+        if self.condensed is True:
+            self.build_condensed()
+            return
+
+        N = self.N
+        n_states = self.n_states
+        n_controls = self.n_controls
+        st_len = n_states * (N + 1)
+        self.st_len = st_len
+        self.dyn_len = st_len
+        c_length = st_len + 8 * N
+        o_length = st_len + n_controls * N
+
+        if self.solver_name == 'hpipm':
+            x_idx = np.arange(st_len).reshape(N + 1, n_states)
+            u_idx = st_len + np.arange(n_controls * N).reshape(N, n_controls)
+            self.perm = np.hstack([np.hstack([x_idx[k], u_idx[k]]) for k in range(N)] + [x_idx[N]])
+            dyn_idx = n_states + np.arange(n_states * N).reshape(N, n_states)  # skips the IC rows
+            fc_idx = st_len + np.arange(8 * N).reshape(N, 8)
+            self.rows = np.hstack([np.hstack([dyn_idx[k], fc_idx[k]]) for k in range(N)])
+            self.qp_data = codegen.load('mpc_qp_ocp', key, self.gen_qp_ocp)
+            opts = {'print_time': 0, 'error_on_fail': 0, 'N': N, 'nx': [n_states] * (N + 1),
+                    'nu': [n_controls] * N + [0], 'ng': [8] * N + [0],
+                    'hpipm': {'iter_max': 100, 'res_g_max': 1e-6, 'res_b_max': 1e-6,
+                              'res_d_max': 1e-6, 'res_m_max': 1e-6}}
+            if self.max_iter is not None:
+                opts['hpipm']['iter_max'] = self.max_iter
+        else:
+            self.qp_data = codegen.load('mpc_qp', key, self.gen_qp_rti if self.rti is True else self.gen_qp)
+            opts = self.qpoases_opts()
+
+        self.solver = cs.conic('S', self.solver_name, {'h': self.qp_data.sparsity_out(0),
+                                                       'a': self.qp_data.sparsity_out(2)}, opts)
+
+        self.lbg = np.full(c_length, -1e10)  # inequality constraints: big enough to act like infinity
+        self.lbg[0:st_len] = 0  # IC + dynamics equality constraint
+        self.ubg = np.zeros(c_length)  # inequality constraints
 
-        i_global = np.dot(np.dot(rz_phi, self.inertia), rz_phi.T)  # is this right?
-        i_inv = np.linalg.inv(i_global)
+        # constraints for optimization variables
+        self.lbx = np.full(o_length, -1e10)  # input inequality constraints
+        self.ubx = np.full(o_length, 1e10)  # input inequality constraints
+        self.lbx[(st_len + 2)::3] = 0  # lower bound on all f1z and f2z
 
-        # vector from CoM to hip in global frame (should just use body frame?)
-        rh_l_g = np.dot(rz_phi, self.rh_l)
-        rh_r_g = np.dot(rz_phi, self.rh_r)
+    def qpoases_opts(self):
+        opts = {'print_time': 0, 'error_on_fail': 0, 'printLevel': "none", 'boundTolerance': 1e-6,
+                'terminationTolerance': 1e-6}
+        if self.max_iter is not None:
+            opts['nWSR'] = self.max_iter
+        return opts
+
+    def gen_qp_ocp(self):
+        """
+        Same QP as gen_qp, reordered stage by stage for hpipm: variables [x0 u0 x1 u1 ... xN] and
+        constraints [gap0 fc0 gap1 fc1 ...] with gap_k = fn(x_k, u_k) - x_(k+1). The initial
+        condition is applied as a bound on x0 instead of a constraint row.
+        """
+        qp_data = self.gen_qp_rti() if self.rti is True else self.gen_qp()
+        p = cs.SX.sym('p', qp_data.size1_in(0))
+        H, h, A, b = qp_data(p)
+        perm = self.perm.tolist()
+        rows = self.rows.tolist()
+        sign = np.ones(len(rows))
+        sign[self.rows < self.dyn_len] = -1  # flip the dynamics rows so x_(k+1) enters with -I
+        sign = cs.DM(sign)
+        return cs.Function('mpc_qp_ocp', [p], [H[perm, perm], h[perm],
+                                               sign * A[rows, perm], sign * b[rows]])
+
+    def build_condensed(self):
+        """
+        Condensed formulation: the states are eliminated with the prediction matrices from condense(),
+        leaving only the 6*N forces and the 8*N friction cone rows for a dense qpOASES solve.
+        """
+        N = self.N
+        mu = self.mu
+        fc_k = np.array([[1, 0, -mu, 0, 0, 0],  # f1x - mu*f1z
+                         [-1, 0, -mu, 0, 0, 0],  # -f1x - mu*f1z
+                         [0, 1, -mu, 0, 0, 0],  # f1y - mu*f1z
+                         [0, -1, -mu, 0, 0, 0],  # -f1y - mu*f1z
+                         [0, 0, 0, 1, 0, -mu],  # f2x - mu*f2z
+                         [0, 0, 0, -1, 0, -mu],  # -f2x - mu*f2z
+                         [0, 0, 0, 0, 1, -mu],  # f2y - mu*f2z
+                         [0, 0, 0, 0, -1, -mu]])  # -f2y - mu*f2z
+        self.fc = np.kron(np.eye(N), fc_k)
+
+        opts = self.qpoases_opts()
+        self.solver = cs.conic('S', 'qpoases', {'h': cs.Sparsity.dense(6 * N, 6 * N),
+                                                'a': cs.DM(self.fc).sparsity()}, opts)
+
+        self.lbg = np.full(8 * N, -1e10)  # inequality constraints: big enough to act like infinity
+        self.ubg = np.zeros(8 * N)
+        self.lbx = np.full(6 * N, -1e10)  # input inequality constraints
+        self.ubx = np.full(6 * N, 1e10)  # input inequality constraints
+        self.lbx[2::3] = 0  # lower bound on all f1z and f2z
+
+    def gen_dynamics(self, rz_phi, i_inv, r1, r2):
+        # numeric discrete dynamics x_next = A*x + B*u + g, same model as fn (see math/dynamics.m)
+        dt = self.dt
+        A = np.eye(self.n_states)
+        A[0:3, 6:9] = rz_phi * dt
+        A[3:6, 9:12] = np.eye(3) * dt
+        B = np.zeros((self.n_states, self.n_controls))
+        B[6:9, 0:3] = np.dot(i_inv, skew(r1)) * dt
+        B[6:9, 3:6] = np.dot(i_inv, skew(r2)) * dt
+        B[9:12, 0:3] = np.eye(3) * dt / self.mass
+        B[9:12, 3:6] = np.eye(3) * dt / self.mass
+        g = np.zeros(self.n_states)
+        g[11] = -9.807 * dt  # gravity integrated over the step, as in gen_fn_nl
+        return A, B, g
+
+    def condense(self, rz_phi, i_inv, r1, r2, x_in, x_ref):
+        """
+        Prediction matrices X = Su*U + Xf for the states x_1...x_N, and the resulting dense QP in U.
+        """
+        N = self.N
+        n_states = self.n_states
+        A, B, g = self.gen_dynamics(rz_phi, i_inv, r1, r2)
+        # (A - I) only maps velocities into positions, so it squares to zero and A^k = I + k*(A - I)
+        A_pow = np.eye(n_states) + np.arange(N + 1)[:, None, None] * (A - np.eye(n_states))
+        AB = np.matmul(A_pow[:N], B)  # A^k*B
+        lag = np.arange(N)[:, None] - np.arange(N)[None, :]  # k - j, block (k, j) of Su is A^(k-j)*B
+        Su = np.where((lag >= 0)[:, :, None, None], AB[np.maximum(lag, 0)], 0)
+        Su = Su.transpose(0, 2, 1, 3).reshape(N * n_states, N * self.n_controls)
+        Xf = np.matmul(A_pow[1:], x_in) + np.cumsum(np.matmul(A_pow[:N], g), axis=0)  # free response
+
+        # x_0 is fixed and x_N carries no cost
+        q = np.tile(np.diag(self.Q), N)
+        q[-n_states:] = 0
+        SuQ = Su.T * q
+        H = 2 * (np.dot(SuQ, Su) + np.kron(np.eye(N), self.R))
+        h = 2 * np.dot(SuQ, Xf.flatten() - np.tile(x_ref, N))
+        return H, h
+
+    def gen_fn(self):
+        # discrete dynamics x_next = fn(x, u, rz_phi, i_inv, r1, r2)
+        theta_x = cs.SX.sym('theta_x')
+        theta_y = cs.SX.sym('theta_y')
+        theta_z = cs.SX.sym('theta_z')
+        p_x = cs.SX.sym('p_x')
+        p_y = cs.SX.sym('p_y')
+        p_z = cs.SX.sym('p_z')
+        omega_x = cs.SX.sym('omega_x')
+        omega_y = cs.SX.sym('omega_y')
+        omega_z = cs.SX.sym('omega_z')
+        pdot_x = cs.SX.sym('pdot_x')
+        pdot_y = cs.SX.sym('pdot_y')
+        pdot_z = cs.SX.sym('pdot_z')
+        states = [theta_x, theta_y, theta_z,
+                  p_x, p_y, p_z,
+                  omega_x, omega_y, omega_z,
+                  pdot_x, pdot_y, pdot_z]  # state vector x
 
-        r1 = r1 + rh_l_g
-        r2 = r2 + rh_r_g
+        f1_x = cs.SX.sym('f1_x')  # controls
+        f1_y = cs.SX.sym('f1_y')  # controls
+        f1_z = cs.SX.sym('f1_z')  # controls
+        f2_x = cs.SX.sym('f2_x')  # controls
+        f2_y = cs.SX.sym('f2_y')  # controls
+        f2_z = cs.SX.sym('f2_z')  # controls
+        controls = [f1_x, f1_y, f1_z, f2_x, f2_y, f2_z]
+
+        rz_phi = cs.SX.sym('rz_phi', 3, 3)  # rotation matrix Rz(phi)
+        i_inv = cs.SX.sym('i_inv', 3, 3)  # inverse of inertia tensor in global frame
+        r1 = cs.SX.sym('r1', 3)  # vector from CoM to left foot
+        r2 = cs.SX.sym('r2', 3)  # vector from CoM to right foot
+        model = [rz_phi, i_inv, r1, r2]
 
         i11 = i_inv[0, 0]
         i12 = i_inv[0, 1]
@@ -116,39 +307,9 @@ class Mpc:
         r2y = r2[1]
         r2z = r2[2]
 
-        theta_x = cs.SX.sym('theta_x')
-        theta_y = cs.SX.sym('theta_y')
-        theta_z = cs.SX.sym('theta_z')
-        p_x = cs.SX.sym('p_x')
-        p_y = cs.SX.sym('p_y')
-        p_z = cs.SX.sym('p_z')
-        omega_x = cs.SX.sym('omega_x')
-        omega_y = cs.SX.sym('omega_y')
-        omega_z = cs.SX.sym('omega_z')
-        pdot_x = cs.SX.sym('pdot_x')
-        pdot_y = cs.SX.sym('pdot_y')
-        pdot_z = cs.SX.sym('pdot_z')
-        states = [theta_x, theta_y, theta_z,
-                  p_x, p_y, p_z,
-                  omega_x, omega_y, omega_z,
-                  pdot_x, pdot_y, pdot_z]  # state vector x
-        n_states = len(states)  # number of states
-
-        f1_x = cs.SX.sym('f1_x')  # controls
-        f1_y = cs.SX.sym('f1_y')  # controls
-        f1_z = cs.SX.sym('f1_z')  # controls
-        f2_x = cs.SX.sym('f2_x')  # controls
-        f2_y = cs.SX.sym('f2_y')  # controls
-        f2_z = cs.SX.sym('f2_z')  # controls
-        controls = [f1_x, f1_y, f1_z, f2_x, f2_y, f2_z]
-        n_controls = len(controls)  # number of controls
-
         gravity = -9.807
         dt = self.dt
         mass = self.mass
-        # gravity = cs.SX.sym("gravity")
-        # dt = cs.SX.sym("dt")
-        # mass = cs.SX.sym("mass")
         # x_next = np.dot(A, states) + np.dot(B, controls) + g  # the discrete dynamics of the system
         x_next = [dt * omega_x * rz11 + dt * omega_y * rz12 + dt * omega_z * rz13 + theta_x,
                   dt * omega_x * rz21 + dt * omega_y * rz22 + dt * omega_z * rz23 + theta_y,
@@ -167,44 +328,122 @@ class Mpc:
                   + dt * f2_y * (-i31 * r2z + i33 * r2x) + dt * f2_z * (i31 * r2y - i32 * r2x) + omega_z,
                   dt * f1_x / mass + dt * f2_x / mass + pdot_x,
                   dt * f1_y / mass + dt * f2_y / mass + pdot_y,
-                  dt * f1_z / mass + dt * f2_z / mass + gravity + pdot_z]
+                  dt * f1_z / mass + dt * f2_z / mass + dt * gravity + pdot_z]
+
+        fn = cs.Function('fn', [cs.vertcat(*states), cs.vertcat(*controls)] + model,
+                         [cs.vertcat(*x_next)])  # mapping of function f(x,u)
+
+        return fn
+
+    def gen_fn_nl(self):
+        """
+        Nonlinear discrete dynamics x_next = fn_nl(x, u, foot1, foot2), explicit Euler over dt.
+        Unlike gen_fn, the body rotation is kept in full: theta are the sxyz Euler angles (R = Rz*Ry*Rx),
+        their rates come from the exact world angular velocity map, the world inertia is R*I*R.T with
+        the gyroscopic term, and the lever arms foot - p move with the CoM.
+        """
+        x = cs.SX.sym('x', self.n_states)
+        u = cs.SX.sym('u', self.n_controls)
+        foot1 = cs.SX.sym('foot1', 3)  # left foot position in the world frame
+        foot2 = cs.SX.sym('foot2', 3)  # right foot position in the world frame
+
+        theta = x[0:3]
+        p = x[3:6]
+        omega = x[6:9]
+        pdot = x[9:12]
+        f1 = u[0:3]
+        f2 = u[3:6]
+
+        ca = cs.cos(theta[0])
+        sa = cs.sin(theta[0])
+        cb = cs.cos(theta[1])
+        sb = cs.sin(theta[1])
+        cg = cs.cos(theta[2])
+        sg = cs.sin(theta[2])
+        rx = cs.vertcat(cs.horzcat(1, 0, 0), cs.horzcat(0, ca, -sa), cs.horzcat(0, sa, ca))
+        ry = cs.vertcat(cs.horzcat(cb, 0, sb), cs.horzcat(0, 1, 0), cs.horzcat(-sb, 0, cb))
+        rz = cs.vertcat(cs.horzcat(cg, -sg, 0), cs.horzcat(sg, cg, 0), cs.horzcat(0, 0, 1))
+        rot = cs.mtimes([rz, ry, rx])  # body to world
+        # world angular velocity to Euler angle rates, reduces to rz_phi when roll and pitch are zero
+        e_inv = cs.vertcat(cs.horzcat(cg, sg, 0),
+                           cs.horzcat(-sg * cb, cg * cb, 0),
+                           cs.horzcat(cg * sb, sg * sb, cb)) / cb
+
+        i_world = cs.mtimes([rot, cs.DM(self.inertia), rot.T])
+        i_inv = cs.mtimes([rot, cs.DM(np.linalg.inv(self.inertia)), rot.T])
+        torque = cs.cross(foot1 - p, f1) + cs.cross(foot2 - p, f2)
+        omega_dot = cs.mtimes(i_inv, torque - cs.cross(omega, cs.mtimes(i_world, omega)))
+        g = cs.DM([0, 0, -9.807])
+        pdd = (f1 + f2) / self.mass + g
 
-        self.fn = cs.Function('fn', [theta_x, theta_y, theta_z,
-                                     p_x, p_y, p_z,
-                                     omega_x, omega_y, omega_z,
-                                     pdot_x, pdot_y, pdot_z,
-                                     f1_x, f1_y, f1_z,
-                                     f2_x, f2_y, f2_z],
-                              x_next)  # nonlinear mapping of function f(x,u)
+        dt = self.dt
+        x_next = cs.vertcat(theta + dt * cs.mtimes(e_inv, omega),
+                            p + dt * pdot,
+                            omega + dt * omega_dot,
+                            pdot + dt * pdd)
+
+        return cs.Function('fn_nl', [x, u, foot1, foot2], [x_next])
+
+    def gen_qp(self):
+        # QP matrices as a function of the parameters: objective 0.5*x.T*H*x + h.T*x, constraints g = A*x + b
+        fn = self.gen_fn()
+
+        rz_phi = cs.SX.sym('rz_phi', 3, 3)  # rotation matrix Rz(phi)
+        i_inv = cs.SX.sym('i_inv', 3, 3)  # inverse of inertia tensor in global frame
+        r1 = cs.SX.sym('r1', 3)  # vector from CoM to left foot
+        r2 = cs.SX.sym('r2', 3)  # vector from CoM to right foot
+        model = [rz_phi, i_inv, r1, r2]
+
+        st_ref = cs.SX.sym('st_ref', self.n_states + self.n_states)  # initial and reference states
+        # parameters: initial and reference states followed by the model values, column-major like casadi
+        parameters = cs.vertcat(st_ref, *[cs.vec(m) for m in model])
+
+        return self.gen_qp_terms('mpc_qp', parameters, st_ref, lambda k, st, con: fn(st, con, *model))
+
+    def gen_qp_rti(self):
+        """
+        Real-time iteration: the nonlinear dynamics of gen_fn_nl, linearized along a given trajectory
+        (x_bar, u_bar). Each step becomes x_(k+1) = f(x_bar_k, u_bar_k) + A_k*(x_k - x_bar_k) + B_k*(u_k - u_bar_k),
+        one Gauss-Newton QP with the same variables, constraints and sparsity as gen_qp.
+        """
+        N = self.N
+        n_states = self.n_states
+        n_controls = self.n_controls
+        fn = self.gen_fn_nl()
 
-        u = cs.SX.sym('u', n_controls, self.N)  # decision variables, control action matrix
         st_ref = cs.SX.sym('st_ref', n_states + n_states)  # initial and reference states
+        feet = cs.SX.sym('feet', 6)  # left and right foot positions in the world frame
+        x_bar = cs.SX.sym('x_bar', n_states, N + 1)  # linearization trajectory
+        u_bar = cs.SX.sym('u_bar', n_controls, N)
+        parameters = cs.vertcat(st_ref, feet, cs.vec(x_bar), cs.vec(u_bar))
+
+        xs = cs.SX.sym('xs', n_states)
+        us = cs.SX.sym('us', n_controls)
+        f = fn(xs, us, feet[0:3], feet[3:6])
+        lin = cs.Function('lin', [xs, us, feet], [f, cs.jacobian(f, xs), cs.jacobian(f, us)])
+
+        def step(k, st, con):
+            f_k, A_k, B_k = lin(x_bar[:, k], u_bar[:, k], feet)
+            return f_k + cs.mtimes(A_k, st - x_bar[:, k]) + cs.mtimes(B_k, con - u_bar[:, k])
+
+        return self.gen_qp_terms('mpc_qp', parameters, st_ref, step)
+
+    def gen_qp_terms(self, name, parameters, st_ref, step):
+        """
+        Objective and constraints shared by every sparse formulation, returned as the Function
+        name(parameters) -> [H, h, A, b].
+        :param step: step(k, x_k, u_k), predicted state x_(k+1)
+        """
+        n_states = self.n_states
+        n_controls = self.n_controls
+
+        u = cs.SX.sym('u', n_controls, self.N)  # decision variables, control action matrix
         x = cs.SX.sym('x', n_states, (self.N + 1))  # represents the states over the opt problem.
 
         obj = 0  # objective function
         constr = []  # constraints vector
-        k = 10
-        Q = np.zeros((12, 12))  # state weighing matrix
-        Q[0, 0] = k
-        Q[1, 1] = k
-        Q[2, 2] = k
-        Q[3, 3] = k
-        Q[4, 4] = k
-        Q[5, 5] = k
-        Q[6, 6] = k
-        Q[7, 7] = k
-        Q[8, 8] = k
-        Q[9, 9] = k
-        Q[10, 10] = k
-        Q[11, 11] = k
-
-        R = np.zeros((6, 6))  # control weighing matrix
-        R[0, 0] = k/2
-        R[1, 1] = k/2
-        R[2, 2] = k/2
-        R[3, 3] = k/2
-        R[4, 4] = k/2
-        R[5, 5] = k/2
+        Q = self.Q  # state weighing matrix
+        R = self.R  # control weighing matrix
 
         constr = cs.vertcat(constr, x[:, 0] - st_ref[0:n_states])  # initial condition constraints
         # compute objective and constraints
@@ -212,15 +451,11 @@ class Mpc:
             st = x[:, k]  # state
             con = u[:, k]  # control action
             # calculate objective
-            # why not just plug x_in and x_ref directly into st_ref??
             obj = obj + cs.mtimes(cs.mtimes((st - st_ref[n_states:(n_states * 2)]).T, Q),
                                   st - st_ref[n_states:(n_states * 2)]) \
                 + cs.mtimes(cs.mtimes(con.T, R), con)
             st_next = x[:, k + 1]
-            f_value = self.fn(st[0], st[1], st[2], st[3], st[4], st[5],
-                              st[6], st[7], st[8], st[9], st[10], st[11],
-                              con[0], con[1], con[2], con[3], con[4], con[5])
-            st_n_e = np.array(f_value)
+            st_n_e = step(k, st, con)
             constr = cs.vertcat(constr, st_next - st_n_e)  # compute constraints
 
         # add additional constraints
@@ -239,60 +474,206 @@ class Mpc:
 
         opt_variables = cs.vertcat(cs.reshape(x, n_states * (self.N + 1), 1),
                                    cs.reshape(u, n_controls * self.N, 1))
-        qp = {'x': opt_variables, 'f': obj, 'g': constr, 'p': st_ref}
-        opts = {'print_time': 0, 'error_on_fail': 0, 'printLevel': "none", 'boundTolerance': 1e-6,
-                'terminationTolerance': 1e-6}
-        solver = cs.qpsol('S', 'qpoases', qp, opts)
+        H, h, c = cs.quadratic_coeff(obj, opt_variables)
+        A, b = cs.linear_coeff(constr, opt_variables)
 
-        c_length = np.shape(constr)[0]
-        o_length = np.shape(opt_variables)[0]
+        return cs.Function(name, [parameters], [H, h, A, b])
 
-        lbg = list(itertools.repeat(-1e10, c_length))  # inequality constraints: big enough to act like infinity
-        lbg[0:(self.N + 1)] = itertools.repeat(0, self.N + 1)  # IC + dynamics equality constraint
-        ubg = list(itertools.repeat(0, c_length))  # inequality constraints
+    def mpcontrol(self, rz_phi, r1, r2, x_in, x_ref, c_l, c_r, t=0.):
+        """
+        Solves the MPC and returns the whole force plan.
+        :param t: time at which x_in was measured
+        :return: t_plan, start time of each step (N,), and u, forces [f1, f2] for each step (N, 6)
+        """
 
-        # constraints for optimization variables
-        lbx = list(itertools.repeat(-1e10, o_length))  # input inequality constraints
-        ubx = list(itertools.repeat(1e10, o_length))  # input inequality constraints
+        i_global = np.dot(np.dot(rz_phi, self.inertia), rz_phi.T)  # is this right?
+        i_inv = np.linalg.inv(i_global)
+
+        # vector from CoM to hip in global frame (should just use body frame?)
+        rh_l_g = np.dot(rz_phi, self.rh_l)
+        rh_r_g = np.dot(rz_phi, self.rh_r)
+
+        r1 = r1 + rh_l_g
+        r2 = r2 + rh_r_g
 
-        st_len = n_states * (self.N + 1)
+        n_states = self.n_states
+        n_controls = self.n_controls
+        st_len = self.st_len
 
-        lbx[(st_len + 2)::3] = [0 for i in range(20)]  # lower bound on all f1z and f2z
+        lbx = np.copy(self.lbx)
+        ubx = np.copy(self.ubx)
+        lbu = lbx[st_len:].reshape(self.N, n_controls)  # views into the control bounds, one row per step
+        ubu = ubx[st_len:].reshape(self.N, n_controls)
 
         if c_l == 0:  # if left leg is not in contact... don't calculate output forces for that leg.
-            ubx[(n_states * (self.N + 1))::6] = [0 for i in range(10)]  # upper bound on all f1x
-            ubx[(n_states * (self.N + 1) + 1)::6] = [0 for i in range(10)]  # upper bound on all f1y
-            lbx[(n_states * (self.N + 1))::6] = [0 for i in range(10)]  # lower bound on all f1x
-            lbx[(n_states * (self.N + 1) + 1)::6] = [0 for i in range(10)]  # lower bound on all f1y
-            ubx[(n_states * (self.N + 1) + 2)::6] = [0 for i in range(10)]  # upper bound on all f1z
+            lbu[:, 0:3] = 0  # lower bound on all f1x, f1y, f1z
+            ubu[:, 0:3] = 0  # upper bound on all f1x, f1y, f1z
 
         if c_r == 0:  # if right leg is not in contact... don't calculate output forces for that leg.
-            ubx[(n_states * (self.N + 1) + 3)::6] = [0 for i in range(10)]  # upper bound on all f2x
-            ubx[(n_states * (self.N + 1) + 4)::6] = [0 for i in range(10)]  # upper bound on all f2y
-            lbx[(n_states * (self.N + 1) + 3)::6] = [0 for i in range(10)]  # lower bound on all f2x
-            lbx[(n_states * (self.N + 1) + 4)::6] = [0 for i in range(10)]  # lower bound on all f2y
-            ubx[(n_states * (self.N + 1) + 5)::6] = [0 for i in range(10)]  # upper bound on all f2z
+            lbu[:, 3:6] = 0  # lower bound on all f2x, f2y, f2z
+            ubu[:, 3:6] = 0  # upper bound on all f2x, f2y, f2z
 
         # setup is finished, now solve-------------------------------------------------------------------------------- #
 
-        u0 = np.zeros((self.N, n_controls))  # six control inputs
-        X0 = np.matlib.repmat(x_in, 1, self.N + 1).T  # initialization of the state's decision variables
-
-        # parameters and xin must be changed every timestep
-        parameters = cs.vertcat(x_in, x_ref)  # set values of parameters vector
-        # init value of optimization variables
-        x0 = cs.vertcat(np.reshape(X0.T, (n_states * (self.N + 1), 1)),
-                        np.reshape(u0.T, (n_controls * self.N, 1)))
-
-        sol = solver(x0=x0, lbx=lbx, ubx=ubx, lbg=lbg, ubg=ubg, p=parameters)
-
-        solu = np.array(sol['x'][n_states * (self.N + 1):])
-        u = np.reshape(solu.T, (n_controls, self.N)).T  # get controls from the solution
-
-        u_cl = u[0, :]  # ignore rows other than new first row
+        if self.warm_start is True and self.x_prev is not None:
+            x0, lam_x0, lam_g0 = self.shift(self.x_prev, self.lam_x_prev, self.lam_g_prev)
+            if st_len > 0:
+                x0[0:n_states] = x_in  # first state is known
+        else:
+            u0 = np.zeros((self.N, n_controls))  # six control inputs
+            X0 = np.matlib.repmat(x_in, 1, st_len // n_states).T  # initialization of the state's decision variables
+            # init value of optimization variables
+            x0 = np.hstack([np.reshape(X0, -1), np.reshape(u0, -1)])
+            lam_x0 = np.zeros(np.shape(x0))
+            lam_g0 = np.zeros(np.shape(self.lbg))
+
+        if self.condensed is True:
+            H, h = self.condense(rz_phi=rz_phi, i_inv=i_inv, r1=r1, r2=r2, x_in=x_in, x_ref=x_ref)
+            A = self.fc
+            b = np.zeros(np.shape(self.lbg))
+        elif self.rti is True:
+            # linearize along the warm start, i.e. the previous solution shifted one step, with x_0 = x_in
+            feet = np.hstack([x_in[3:6] + r1, x_in[3:6] + r2])  # stance feet stay put over the horizon
+            parameters = np.hstack([x_in, x_ref, feet, x0])
+            H, h, A, b = self.qp_data(parameters)
+            b = np.array(b).flatten()
+        else:
+            # parameters and xin must be changed every timestep
+            parameters = np.hstack([x_in, x_ref, rz_phi.flatten(order='F'), i_inv.flatten(order='F'), r1, r2])
+            H, h, A, b = self.qp_data(parameters)
+            b = np.array(b).flatten()
+
+        if self.solver_name == 'hpipm':
+            sol = self.solve_ocp(H, h, A, b, lbx, ubx, x0, lam_x0, x_in)
+        else:
+            sol = self.solver(h=H, g=h, a=A, lba=self.lbg - b, uba=self.ubg - b, lbx=lbx, ubx=ubx,
+                              x0=x0, lam_x0=lam_x0, lam_a0=lam_g0)
+
+        stats = self.solver.stats()
+        if stats['success'] is False:
+            self.n_fallback += 1
+            print("WARNING: MPC solve failed (", stats['return_status'], "), falling back to the last feasible plan")
+            return self.fallback(t)
+
+        self.iter_count = stats['iter_count']
+        if self.iter_cold is None:
+            self.iter_cold = self.iter_count
+        elif self.warm_start is True:
+            self.iter_saved += max(self.iter_cold - self.iter_count, 0)
+
+        self.x_prev = np.array(sol['x']).flatten()
+        self.lam_x_prev = np.array(sol['lam_x']).flatten()
+        self.lam_g_prev = np.array(sol['lam_a']).flatten()
+
+        solu = self.x_prev[st_len:]
+        u = np.reshape(solu, (self.N, n_controls))  # get controls from the solution
+        t_plan = t + self.dt * np.arange(self.N)  # each force is held for one step, like in the model
         # ss_error = np.linalg.norm(x0 - x_ref)  # defaults to Euclidean norm
         # print("ss_error = ", ss_error)
 
         # print("Time elapsed for MPC: ", t1 - t0)
-
-        return u_cl
+        self.t_plan = t_plan
+        self.u_plan = u
+
+        return t_plan, u
+
+    def fallback(self, t):
+        # last feasible plan, shifted to start at the step containing t and holding its last step
+        if self.u_plan is None:
+            return t + self.dt * np.arange(self.N), np.zeros((self.N, self.n_controls))  # no plan yet: no force
+        return hold(self.t_plan, self.u_plan, t, self.dt)
+
+    def solve_ocp(self, H, h, A, b, lbx, ubx, x0, lam_x0, x_in):
+        # solves the stage-wise reordered QP with hpipm and returns the solution in the [X; U] layout
+        perm = self.perm
+        rows = self.rows
+        dyn = rows < self.dyn_len
+        lbx = np.copy(lbx)
+        ubx = np.copy(ubx)
+        lbx[0:self.n_states] = x_in  # initial condition as a bound
+        ubx[0:self.n_states] = x_in
+        lba = np.where(dyn, -self.ubg[rows], self.lbg[rows]) - b  # flipped dynamics rows swap their bounds
+        uba = np.where(dyn, -self.lbg[rows], self.ubg[rows]) - b
+
+        with quiet():  # the hpipm plugin prints the whole QP on every solve
+            sol = self.solver(h=H, g=h, a=A, lba=inf(lba), uba=inf(uba), lbx=inf(lbx[perm]), ubx=inf(ubx[perm]),
+                              x0=x0[perm], lam_x0=lam_x0[perm])
+
+        x = np.zeros(len(perm))
+        lam_x = np.zeros(len(perm))
+        lam_g = np.zeros(len(self.lbg))
+        x[perm] = np.array(sol['x']).flatten()
+        lam_x[perm] = np.array(sol['lam_x']).flatten()
+        lam_g[rows] = np.where(dyn, -1, 1) * np.array(sol['lam_a']).flatten()
+        return {'x': x, 'lam_x': lam_x, 'lam_a': lam_g}
+
+    def shift(self, x, lam_x, lam_g):
+        """
+        Shifts a solution of the QP one horizon step forward in time to be used as an initial guess.
+        Each stage drops its first block and repeats the last one.
+        """
+        n_states = self.n_states
+        n_controls = self.n_controls
+        st_len = self.st_len
+        dyn_len = self.dyn_len  # IC + dynamics rows, none in the condensed formulation
+        n_ic = min(n_states, dyn_len)
+        fc_len = 8  # friction cone rows per step
+
+        x0 = np.hstack([shift_blocks(x[:st_len], n_states), shift_blocks(x[st_len:], n_controls)])
+        lam_x0 = np.hstack([shift_blocks(lam_x[:st_len], n_states), shift_blocks(lam_x[st_len:], n_controls)])
+        lam_g0 = np.hstack([lam_g[0:n_ic],  # initial condition multipliers stay with the first state
+                            shift_blocks(lam_g[n_ic:dyn_len], n_states),
+                            shift_blocks(lam_g[dyn_len:], fc_len)])
+
+        return x0, lam_x0, lam_g0
+
+
+def hold(t_plan, u_plan, t, dt):
+    # force plan shifted to start at the step containing t, holding its last step
+    N = len(t_plan)
+    k = max(int(np.floor((t - t_plan[0]) / dt)), 0)  # steps elapsed since the plan was made
+    idx = np.minimum(np.arange(N) + k, N - 1)
+    return t_plan[0] + dt * (np.arange(N) + k), u_plan[idx]
+
+
+def shift_blocks(v, n):
+    # drop the first block of length n and repeat the last one
+    v = np.reshape(v, (-1, n))
+    return np.vstack([v[1:], v[-1:]]).flatten()
+
+
+def inf(v):
+    # the 1e10 "infinite" bounds used with qpOASES would be treated as real bounds by an interior point method
+    return np.where(np.abs(v) >= 1e10, np.copysign(np.inf, v), v)
+
+
+def skew(r):
+    # cross product matrix, skew(a)*b = a x b
+    return np.array([[0, -r[2], r[1]],
+                     [r[2], 0, -r[0]],
+                     [-r[1], r[0], 0]])
+
+
+try:
+    _libc = ctypes.CDLL(None)
+except OSError:
+    _libc = None
+
+
+@contextlib.contextmanager
+def quiet():
+    # discards what C libraries write to stdout in the block, Python's own output included.
+    # The hpipm plugin has no print level option, so fd 1 is redirected, which is process wide:
+    # other threads printing during the block are silenced too. Keep the block to the solve call
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    try:
+        yield
+    finally:
+        if _libc is not None:
+            _libc.fflush(None)  # before restoring, or buffered C output comes out afterwards
+        os.dup2(saved, 1)
+        os.close(saved)
@@ -0,0 +1,70 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import numpy as np
+
+
+class MpcScheduler:
+
+    def __init__(self, mpc_dt=0.025, event=True, stretch=1.5, max_dt=0.1, err_jump=0.05, err_min=1e-2):
+        """
+        Decides on which control ticks the MPC is re-solved.
+        Periodic solves happen every interval seconds. With event=True a gait state machine changing state
+        (swing, stance, early, late) or a jump in the state error triggers a solve at once and resets the
+        interval to mpc_dt; every quiet periodic solve after that stretches it by stretch, up to max_dt.
+        max_dt should stay below the MPC horizon, since the plan is held past its end.
+        Periodic solves are skipped while the state error is below err_min, events never are.
+        """
+        self.mpc_dt = mpc_dt
+        self.event = event
+        self.stretch = stretch
+        self.max_dt = max_dt
+        self.err_jump = err_jump  # change in state error since the last solve that counts as an event
+        self.err_min = err_min
+        self.interval = mpc_dt  # current periodic interval
+        self.t_next = 0  # time of the next periodic solve
+        self.err_solve = None  # state error at the last solve
+        self.states = None  # state machine states on the last tick
+        self.n_solve = 0  # number of solves requested
+        self.n_event = 0  # number of those triggered by an event
+
+    def due(self, t, states, x_in, x_ref):
+        """
+        :param t: current time
+        :param states: current state of each state machine, e.g. (state_l, state_r)
+        :return: (solve, skip), solve is True if the MPC should be solved on this tick, skip is True if a
+        periodic solve was skipped because the state error is small enough
+        """
+        err = np.linalg.norm(x_in - x_ref)
+        changed = self.states is not None and tuple(states) != self.states
+        jumped = self.err_solve is not None and abs(err - self.err_solve) > self.err_jump
+        self.states = tuple(states)
+
+        if self.event is True and (changed or jumped):
+            self.n_event += 1
+            self.interval = self.mpc_dt
+        elif t + 1e-9 < self.t_next:
+            return False, False
+        elif err <= self.err_min:
+            self.t_next = t + self.interval
+            return False, True
+        elif self.event is True:
+            self.interval = max(min(self.interval * self.stretch, self.max_dt), self.mpc_dt)
+
+        self.t_next = t + self.interval
+        self.err_solve = err
+        self.n_solve += 1
+        return True, False
@@ -0,0 +1,176 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import time
+import multiprocessing as mp
+
+import numpy as np
+
+import mpc
+
+
+class Mailbox:
+
+    def __init__(self, size):
+        """
+        Double-buffered mailbox in shared memory for a single writer and a single reader.
+        The writer fills the back buffer and publishes it by flipping the index, so neither side takes a lock.
+        Each buffer row is [sequence number, timestamp, values...]. A sequence number of 0 marks a row
+        that is being written; the reader retries if the row changes under it.
+        :param size: number of values carried per message
+        """
+        self.size = size
+        self.data = mp.RawArray('d', 2 * (size + 2))
+        self.index = mp.RawValue('i', 0)
+        self.seq = 0  # writer side message counter
+
+    def buffers(self):
+        return np.frombuffer(self.data, dtype=float).reshape(2, self.size + 2)
+
+    def post(self, t, values):
+        buf = self.buffers()
+        back = 1 - self.index.value
+        self.seq += 1
+        buf[back, 0] = 0  # invalidate while writing
+        buf[back, 1] = t
+        buf[back, 2:] = values
+        buf[back, 0] = self.seq
+        self.index.value = back  # publish
+
+    def read(self):
+        # returns (sequence number, timestamp, values), or None if nothing has been posted yet
+        buf = self.buffers()
+        for i in range(3):
+            front = self.index.value
+            seq = buf[front, 0]
+            row = np.copy(buf[front])
+            if seq == 0 or seq != buf[front, 0]:
+                continue  # writer got to this row first, try the other one
+            return int(seq), row[1], row[2:]
+        return None
+
+
+def worker(inbox, outbox, wake, done, running, kwargs):
+    # runs in its own process so the QP never holds up the control loop or its GIL
+    os.set_blocking(done.fileno(), False)
+    force = mpc.Mpc(**kwargs)
+    seq_last = 0
+    while running.value:
+        if not wake.poll(0.1):
+            continue
+        while wake.poll():
+            wake.recv_bytes()  # one solve for however many requests piled up, the inbox holds the newest
+        msg = inbox.read()
+        if msg is None or msg[0] == seq_last:
+            continue
+        seq_last, t, v = msg
+        t_plan, u = force.mpcontrol(x_in=v[0:12], x_ref=v[12:24], rz_phi=np.reshape(v[24:33], (3, 3)),
+                                    r1=v[33:36], r2=v[36:39], c_l=v[39], c_r=v[40], t=t)
+        outbox.post(t, np.hstack([seq_last, t_plan, np.reshape(u, -1)]))  # with the request it answers
+        try:
+            done.send_bytes(b'\0')
+        except BlockingIOError:
+            pass  # nobody is waiting on the notifications, see MpcWorker.mpcontrol
+
+
+class MpcWorker:
+
+    def __init__(self, t_budget=None, **kwargs):
+        """
+        Runs the MPC in a background process.
+        The control loop posts the latest state with request() and picks up the newest force plan with latest(),
+        neither of which ever waits for the solver. Plans carry the timestamp of the state they were
+        computed from. The worker is woken through a pipe with a non-blocking write end, so no lock is shared
+        with it (an mp.Event would take one on every request).
+        mpcontrol() instead waits for the plan of its own request, up to t_budget.
+        :param t_budget: wall time budget of mpcontrol() (s), None to always wait for the solution
+        """
+        self.N = kwargs.get('N', 10)  # prediction horizon
+        self.dt = 0.025  # MPC step (s), as in Mpc
+        self.t_budget = t_budget
+        self.n_in = 41  # x_in, x_ref, rz_phi, r1, r2, c_l, c_r
+        self.n_out = 7 * self.N + 1  # request sequence number, step start times and forces for both feet
+        self.inbox = Mailbox(self.n_in)
+        self.outbox = Mailbox(self.n_out)
+        self.wake_r, self.wake_w = mp.Pipe(duplex=False)
+        os.set_blocking(self.wake_w.fileno(), False)
+        self.done_r, self.done_w = mp.Pipe(duplex=False)  # worker to control loop, one byte per solution
+        self.running = mp.RawValue('b', 1)
+        self.process = mp.Process(target=worker, daemon=True,
+                                  args=(self.inbox, self.outbox, self.wake_r, self.done_w, self.running, kwargs))
+        self.seq_last = 0
+        self.seq_req = 0  # request the newest solution answers
+        self.t_sol = None  # timestamp of the state the newest solution was computed from
+        self.t_plan = None  # newest plan
+        self.u_plan = None
+        self.n_fallback = 0  # number of mpcontrol() calls that missed their deadline
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self.running.value = 0
+        self.wakeup()
+        self.process.join()
+
+    def wakeup(self):
+        try:
+            self.wake_w.send_bytes(b'\0')  # under PIPE_BUF, so written whole or not at all
+        except BlockingIOError:
+            pass  # pipe full, the worker has wake-ups queued already
+
+    def request(self, t, rz_phi, r1, r2, x_in, x_ref, c_l, c_r):
+        # returns the sequence number of the request
+        self.inbox.post(t, np.hstack([x_in, x_ref, np.reshape(rz_phi, -1), r1, r2, c_l, c_r]))
+        self.wakeup()
+        return self.inbox.seq
+
+    def latest(self):
+        # newest plan (t_plan, u) not yet picked up, or None
+        msg = self.outbox.read()
+        if msg is None or msg[0] == self.seq_last:
+            return None
+        self.seq_last, self.t_sol, v = msg
+        self.seq_req = int(v[0])
+        self.t_plan = v[1:self.N + 1]
+        self.u_plan = np.reshape(v[self.N + 1:], (self.N, 6))
+        return self.t_plan, self.u_plan
+
+    def mpcontrol(self, rz_phi, r1, r2, x_in, x_ref, c_l, c_r, t=0.):
+        """
+        Same as Mpc.mpcontrol, but the solve runs in the worker and this waits for it at most t_budget.
+        A solve can't be interrupted, so one that misses the deadline carries on in the worker, and the newest
+        plan that has arrived is returned instead, shifted to t as in Mpc.fallback.
+        """
+        while self.done_r.poll():
+            self.done_r.recv_bytes()  # notifications nobody waited for
+        seq = self.request(t=t, rz_phi=rz_phi, r1=r1, r2=r2, x_in=x_in, x_ref=x_ref, c_l=c_l, c_r=c_r)
+        t_end = None if self.t_budget is None else time.perf_counter() + self.t_budget
+        while True:
+            self.latest()
+            if self.seq_req == seq:
+                return self.t_plan, self.u_plan
+            wait = None if t_end is None else t_end - time.perf_counter()
+            if (wait is not None and wait <= 0) or not self.done_r.poll(wait):
+                break
+            self.done_r.recv_bytes()
+
+        self.n_fallback += 1
+        print("WARNING: MPC solve missed its deadline, falling back to the newest plan")
+        if self.u_plan is None:
+            return t + self.dt * np.arange(self.N), np.zeros((self.N, 6))  # no plan yet: no force
+        return mpc.hold(self.t_plan, self.u_plan, t, self.dt)
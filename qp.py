@@ -24,89 +24,200 @@ https://github.com/MMehrez/ ...Sim_3_MPC_Robot_PS_obs_avoid_mul_sh.m
 """
 
 import numpy as np
-import numpy.matlib
-
-import itertools
 
 import casadi as cs
 
+import codegen
 
-class Qp:
 
-    def __init__(self, controller, **kwargs):
+class Qp:
 
+    def __init__(self, controller, solver='numpy', **kwargs):
+        """
+        Relaxation QP on top of the whole body controller, built once and re-solved every tick.
+        J, Mx, x_dd_des, grav and fr_mpc enter as parameters, and each solve is warm started from
+        the previous solution.
+        :param solver: 'numpy' for the specialized active set solver in active_set(), 'casadi' for qpOASES
+        """
         self.u = np.zeros((4, 1))  # control signal
         self.controller = controller
+        self.solver_name = solver
 
-    def qpcontrol(self, fr_mpc):
+        self.n_del_fr = 3  # reaction force relaxation vector (del_f_x, y, z)
+        self.n_del_f = 4  # floating base acceleration relaxation vector (q1, q2, q3, q4)
 
-        n_del_fr = 3  # reaction force relaxation vector (del_f_x, y, z)
-        n_del_f = 4  # floating base acceleration relaxation vector (q1, q2, q3, q4)
+        self.Q1 = np.eye(self.n_del_fr)  # state weighing matrix
+        self.Q2 = np.eye(self.n_del_f)  # control weighing matrix
 
-        g = self.controller.grav  # joint space gravity-induced torque
+        # numpy solver: inverse weights and the bounds active in the previous solution, used as a warm start
+        self.w = 1 / np.hstack([np.diag(self.Q1), np.diag(self.Q2)])
+        self.active = np.zeros(self.n_del_fr, dtype=bool)
+        self.n_iter = 0  # active set iterations used by the last numpy solve
+        self.converged = True  # False if the last solve stopped without an optimal solution
+
+        self.qp_data = None
+        self.solver = None
+        if solver == 'numpy':
+            return
+
+        key = [self.n_del_fr, self.n_del_f, np.diag(self.Q1).tolist(), np.diag(self.Q2).tolist(),
+               codegen.source_hash(__file__)]
+        self.qp_data = codegen.load('wbc_qp', key, self.gen_qp)
+        opts = {'print_time': 0, 'error_on_fail': 0, 'printLevel': "none", 'boundTolerance': 1e-6,
+                'terminationTolerance': 1e-6}
+        self.solver = cs.conic('S', 'qpoases', {'h': self.qp_data.sparsity_out(0),
+                                                'a': self.qp_data.sparsity_out(2)}, opts)
 
-        Q1 = np.zeros((3, 3))  # state weighing matrix
-        Q1[0, 0] = 1
-        Q1[1, 1] = 1
-        Q1[2, 2] = 1
+        c_length = self.n_del_f + self.n_del_fr
+        o_length = self.n_del_fr + self.n_del_f
+        self.lbg = np.zeros(c_length)  # equality constraints
+        self.ubg = np.zeros(c_length)  # equality constraints
+        self.ubg[self.n_del_f:] = 1e10  # fr >= 0
 
-        Q2 = np.zeros((4, 4))  # control weighing matrix
-        Q2[0, 0] = 1
-        Q2[1, 1] = 1
-        Q2[2, 2] = 1
-        Q2[3, 3] = 1
+        # opt variable constraints
+        self.lbx = np.full(o_length, -1e10)  # input inequality constraints
+        self.ubx = np.full(o_length, 1e10)  # input inequality constraints
+
+        # warm start: previous primal/dual solution
+        self.x_prev = np.zeros(o_length)
+        self.lam_x_prev = np.zeros(o_length)
+        self.lam_g_prev = np.zeros(c_length)
+
+    def gen_qp(self):
+        # QP matrices as a function of the parameters: objective 0.5*x.T*H*x + h.T*x, constraints g = A*x + b
+        n_del_fr = self.n_del_fr
+        n_del_f = self.n_del_f
+
+        J = cs.SX.sym('J', 3, 4)  # end effector Jacobian
+        Mx = cs.SX.sym('Mx', 3, 3)  # end effector space mass matrix
+        x_dd_des = cs.SX.sym('x_dd_des', 3)  # desired end effector acceleration
+        g = cs.SX.sym('g', 4)  # joint space gravity-induced torque
+        fr_mpc = cs.SX.sym('fr_mpc', 3)  # reaction force from the MPC
+        model = [J, Mx, x_dd_des, g, fr_mpc]
 
         # compute objective
         del_fr = cs.SX.sym('del_fr', n_del_fr)  # decision variables, control action matrix
         del_f = cs.SX.sym('del_f', n_del_f)  # represents the states over the opt problem.
 
-        obj = cs.mtimes(cs.mtimes(del_fr.T, Q1), del_fr) + cs.mtimes(cs.mtimes(del_f.T, Q2), del_f)
-        # are the transposes actually working correctly? TODO: Check.
-        # compute constraints
+        obj = cs.mtimes(cs.mtimes(del_fr.T, self.Q1), del_fr) + cs.mtimes(cs.mtimes(del_f.T, self.Q2), del_f)
 
-        A = np.dot(np.dot(self.controller.J.T, self.controller.Mx), self.controller.J)  # A = Mq = J.T*Mx*J
-        q_dd_des = np.dot(self.controller.J.T, self.controller.x_dd_des).reshape(-1, )
-        # q_dd_des = self.controller.x_dd_des
+        # compute constraints
+        A = cs.mtimes(cs.mtimes(J.T, Mx), J)  # A = Mq = J.T*Mx*J
+        q_dd_des = cs.mtimes(J.T, x_dd_des)
         fr = fr_mpc + del_fr  # GRF
-        q_dd = q_dd_des + del_f  # cs.SX.sym('q_dd', 4)  # resultant joint acceleration
+        q_dd = q_dd_des + del_f  # resultant joint acceleration
         Aqdd = cs.mtimes(A, q_dd)
-        Jfr = cs.mtimes(self.controller.J.T, fr)
-
-        constr = []
-        for k in range(0, n_del_f):
-            constr = cs.vertcat(constr, Aqdd[k] - g[k] - Jfr[k])  # Aq + g = J.T*fr
+        Jfr = cs.mtimes(J.T, fr)
 
-        for k in range(0, n_del_fr):
-            constr = cs.vertcat(constr, fr[k])  # fr >= 0
+        constr = cs.vertcat(Aqdd - g - Jfr,  # Aq + g = J.T*fr
+                            fr)  # fr >= 0
 
         opt_variables = cs.vertcat(del_fr, del_f)
+        # parameters, matrices column-major like casadi
+        parameters = cs.vertcat(*[cs.vec(m) for m in model])
+        H, h, c = cs.quadratic_coeff(obj, opt_variables)
+        A, b = cs.linear_coeff(constr, opt_variables)
 
-        qp = {'x': opt_variables, 'f': obj, 'g': constr}
-        opts = {'print_time': 0, 'error_on_fail': 0, 'printLevel': "high", 'boundTolerance': 1e-6,
-                'terminationTolerance': 1e-6}
-        solver = cs.qpsol('S', 'qpoases', qp, opts)
+        return cs.Function('wbc_qp', [parameters], [H, h, A, b])
 
-        # check this since we changed horizon length
-        c_length = np.shape(constr)[0]
-        o_length = np.shape(opt_variables)[0]
+    def qpcontrol(self, fr_mpc):
 
-        lbg = list(itertools.repeat(0, c_length))  # equality constraints
-        ubg = list(itertools.repeat(0, c_length))  # equality constraints
-        ubg[4:7] = list(itertools.repeat(1e10, n_del_fr))   # fr >= 0
+        controller = self.controller
+        if self.solver_name == 'numpy':
+            z = self.active_set(controller.J, controller.Mx, controller.x_dd_des, controller.grav, fr_mpc)
+            return z[0:self.n_del_fr].reshape(-1, 1)
 
-        # opt variable constraints
-        lbx = list(itertools.repeat(-1e10, o_length))  # input inequality constraints
-        ubx = list(itertools.repeat(1e10, o_length))  # input inequality constraints
+        parameters = np.hstack([controller.J.flatten(order='F'), controller.Mx.flatten(order='F'),
+                                np.reshape(controller.x_dd_des, -1), controller.grav, np.reshape(fr_mpc, -1)])
+        H, h, A, b = self.qp_data(parameters)
+        b = np.array(b).flatten()
 
-        # setup is finished, now solve-------------------------------------------------------------------------------- #
-        # init value of optimization variables
-        x0 = cs.vertcat(np.zeros(n_del_fr), np.zeros(n_del_f))
+        sol = self.solver(h=H, g=h, a=A, lba=self.lbg - b, uba=self.ubg - b, lbx=self.lbx, ubx=self.ubx,
+                          x0=self.x_prev, lam_x0=self.lam_x_prev, lam_a0=self.lam_g_prev)
+        self.converged = self.solver.stats()['success']
 
-        sol = solver(x0=x0, lbx=lbx, ubx=ubx, lbg=lbg, ubg=ubg)
+        self.x_prev = np.array(sol['x']).flatten()
+        self.lam_x_prev = np.array(sol['lam_x']).flatten()
+        self.lam_g_prev = np.array(sol['lam_a']).flatten()
 
-        sol_del_f = np.array(sol['x'][n_del_fr:])
+        sol_del_f = np.array(sol['x'][self.n_del_fr:])
 
-        sol_del_fr = np.array(sol['x'][0:n_del_fr])
+        sol_del_fr = np.array(sol['x'][0:self.n_del_fr])
 
         return sol_del_fr
 
+    def active_set(self, J, Mx, x_dd_des, grav, fr_mpc, tol=1e-9):
+        """
+        Solves the same QP as gen_qp without CasADi, exploiting its structure.
+        The equality rows are J.T*(Mx*J*(J.T*x_dd_des + del_f) - fr_mpc - del_fr) = grav, and J.T has full column
+        rank, so they reduce to the 3 rows G*z = d with G = [-I, Mx*J] and z = [del_fr, del_f]. G always has full
+        row rank, so every KKT solve is the 3x3 system G_F*W_F^-1*G_F.T*nu = d - G_A*z_A, z_F = W_F^-1*G_F.T*nu.
+        The bounds fr = fr_mpc + del_fr >= 0 are handled by a primal active set loop started from the previous
+        active set. If grav has a component outside the range of J.T the equalities can't hold exactly, and the
+        least squares solution is returned instead of failing. The same goes for a singular J, see solve3.
+        If the loop runs out of iterations, converged is set to False and the last iterate is returned.
+        :return: z = [del_fr, del_f]
+        """
+        n_fr = self.n_del_fr
+        w_f = self.w[n_fr:]
+        fr_mpc = np.ravel(fr_mpc)
+        # ndarray methods rather than np.dot etc. skip numpy's dispatch overhead, which dominates at this size
+        MxJ = Mx.dot(J)
+        d = np.array(solve3(J.dot(J.T), J.dot(grav))) - MxJ.dot(J.T.dot(x_dd_des.ravel())) + fr_mpc
+        K_f = (MxJ * w_f).dot(MxJ.T)  # contribution of the del_f columns, the same for every active set
+
+        # the loop only touches 3x3 and 3-vectors, plain floats are much cheaper than numpy calls at this size
+        K_f = K_f.tolist()
+        d = d.tolist()
+        lb = (-fr_mpc).tolist()  # lower bound on del_fr
+        w_fr = self.w[:n_fr].tolist()
+        active = self.active.tolist()
+        self.converged = True
+        for it in range(4 * n_fr):
+            self.n_iter = it + 1
+            K = [row[:] for row in K_f]
+            r = d[:]
+            for i in range(n_fr):
+                if active[i]:
+                    r[i] += lb[i]  # the del_fr columns of G are -I
+                else:
+                    K[i][i] += w_fr[i]
+            nu = solve3(K, r)
+            z_fr = [lb[i] if active[i] else -w_fr[i] * nu[i] for i in range(n_fr)]
+            viol = [lb[i] - z_fr[i] for i in range(n_fr)]
+            i = max(range(n_fr), key=viol.__getitem__)
+            if viol[i] > tol:
+                active[i] = True  # add the most violated bound
+                continue
+            # bound multipliers from stationarity, W*z - G.T*nu = lam
+            lam = [z_fr[i] / w_fr[i] + nu[i] if active[i] else 0 for i in range(n_fr)]
+            i = min(range(n_fr), key=lam.__getitem__)
+            if lam[i] < -tol:
+                active[i] = False  # drop the bound pulling the wrong way
+                continue
+            break
+        else:
+            self.converged = False
+            print("WARNING: whole body QP active set did not converge in", 4 * n_fr, "iterations")
+
+        self.active = np.array(active)
+        return np.concatenate([z_fr, w_f * MxJ.T.dot(nu)])
+
+
+def solve3(M, r, tol=1e-12):
+    # solves the 3x3 system M*x = r by Cramer's rule, much cheaper than np.linalg.solve at this size
+    # takes arrays or nested lists and returns a list of floats
+    # a (near) singular M, with |det| under tol relative to its largest entry cubed, gets the least squares
+    # solution of minimum norm instead, dropping singular values under 1e-9 of the largest
+    (a, b, c), (d, e, f), (g, h, i) = M.tolist() if isinstance(M, np.ndarray) else M
+    r0, r1, r2 = r.tolist() if isinstance(r, np.ndarray) else r
+    A = e * i - f * h
+    B = f * g - d * i
+    C = d * h - e * g
+    det = a * A + b * B + c * C
+    scale = max(abs(a), abs(b), abs(c), abs(d), abs(e), abs(f), abs(g), abs(h), abs(i))
+    if abs(det) <= tol * scale ** 3:
+        return np.linalg.lstsq(np.array(M, dtype=float), np.array([r0, r1, r2]), rcond=1e-9)[0].tolist()
+    return [(r0 * A + r1 * (c * h - b * i) + r2 * (b * f - c * e)) / det,
+            (r0 * B + r1 * (a * i - c * g) + r2 * (c * d - a * f)) / det,
+            (r0 * C + r1 * (b * g - a * h) + r2 * (a * e - b * d)) / det]
@@ -0,0 +1,100 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Quaternion and rotation helpers for single orientations, used every tick by the controllers.
+Quaternions are [w, x, y, z] as in transforms3d. The functions write into out when it is given,
+and work on Python floats, which is quicker than NumPy for 4 elements.
+"""
+import math
+
+import numpy as np
+
+_EPS4 = np.finfo(float).eps * 4.0
+
+
+def _write(out, w, x, y, z):
+    if out is None:
+        return np.array([w, x, y, z])
+    out[0] = w
+    out[1] = x
+    out[2] = y
+    out[3] = z
+    return out
+
+
+def euler2quat(ai, aj, ak, out=None):
+    # rotation about static x by ai, then y by aj, then z by ak, as transforms3d.euler.euler2quat(axes='sxyz')
+    ci, si = math.cos(ai / 2), math.sin(ai / 2)
+    cj, sj = math.cos(aj / 2), math.sin(aj / 2)
+    ck, sk = math.cos(ak / 2), math.sin(ak / 2)
+    cc, cs, sc, ss = ci * ck, ci * sk, si * ck, si * sk
+    return _write(out, cj * cc + sj * ss, cj * sc - sj * cs, cj * ss + sj * cc, cj * cs - sj * sc)
+
+
+def mult(a, b, out=None):
+    # a*b
+    w1, x1, y1, z1 = a[0], a[1], a[2], a[3]
+    w2, x2, y2, z2 = b[0], b[1], b[2], b[3]
+    return _write(out,
+                  w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                  w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                  w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2,
+                  w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2)
+
+
+def mult_conj(a, b, out=None):
+    # a*conj(b), the rotation from b to a
+    w1, x1, y1, z1 = a[0], a[1], a[2], a[3]
+    w2, x2, y2, z2 = b[0], -b[1], -b[2], -b[3]
+    return _write(out,
+                  w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                  w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                  w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2,
+                  w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2)
+
+
+def rx_rz(a, b, out=None):
+    # Rx(a)*Rz(b), e.g. the end effector of a leg from q0 and q1 + q2 + q3, see Leg.rotation
+    ca, sa = math.cos(a / 2), math.sin(a / 2)
+    cb, sb = math.cos(b / 2), math.sin(b / 2)
+    return _write(out, ca * cb, sa * cb, -sa * sb, ca * sb)
+
+
+def from_mat(R, out=None):
+    # rotation matrix to unit quaternion with w >= 0, the single matrix version of leg.mat2quat
+    (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = R.tolist()
+    t = (1 + r00 + r11 + r22, 1 + r00 - r11 - r22, 1 - r00 + r11 - r22, 1 - r00 - r11 + r22)
+    if t[0] >= t[1] and t[0] >= t[2] and t[0] >= t[3]:
+        q = (t[0], r21 - r12, r02 - r20, r10 - r01)
+    elif t[1] >= t[2] and t[1] >= t[3]:
+        q = (r21 - r12, t[1], r01 + r10, r02 + r20)
+    elif t[2] >= t[3]:
+        q = (r02 - r20, r01 + r10, t[2], r12 + r21)
+    else:
+        q = (r10 - r01, r02 + r20, r12 + r21, t[3])
+    n = math.sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    if q[0] < 0:
+        n = -n
+    return _write(out, q[0] / n, q[1] / n, q[2] / n, q[3] / n)
+
+
+def pitch(R):
+    # rotation about y of R = Ry(a)*Rx(b)*Rz(c), transforms3d.euler.mat2euler(R, axes='ryxz')[0]
+    r02 = R[0, 2]
+    r22 = R[2, 2]
+    if math.sqrt(r02 * r02 + r22 * r22) > _EPS4:
+        return math.atan2(r02, r22)
+    return 0.0  # gimbal lock, transforms3d puts the whole rotation on c
@@ -0,0 +1,352 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Reference Material:
+
+Rigid Body Dynamics Algorithms
+Roy Featherstone
+"""
+
+import numpy as np
+
+import xml.etree.ElementTree as ET
+
+
+class Model:
+
+    def __init__(self, path, tip=None):
+        """
+        Kinematic tree of revolute joints parsed from a URDF.
+        Inverse dynamics by recursive Newton-Euler (rnea), the joint space mass matrix by composite rigid
+        bodies (crba) and geometric Jacobians, all on arrays allocated once here.
+        Spatial vectors are [angular, linear] as in Featherstone, Jacobians are [linear, angular] as in leg.py.
+        Link i is the child link of joint i, its frame sits on joint i. Base frame quantities are in the frame
+        of the root link.
+        :param path: URDF file
+        :param tip: name of a link, only the joints from the root to this link are kept if given
+        """
+        links, joints = parse(path)
+        children = set(j['child'] for j in joints)
+        roots = [name for name in links if name not in children]
+        if len(roots) != 1:
+            raise ValueError("URDF " + path + " must have exactly one root link, found " + str(roots))
+        self.root = roots[0]
+
+        if tip is not None:
+            by_child = {j['child']: j for j in joints}
+            if tip not in by_child:
+                raise ValueError("link " + tip + " is not moved by any joint in " + path)
+            chain = []
+            while tip in by_child:
+                chain.insert(0, by_child[tip])
+                tip = by_child[tip]['parent']
+            joints = chain
+        else:
+            order = []  # parents before children
+            frontier = [self.root]
+            while frontier:
+                name = frontier.pop(0)
+                for j in joints:
+                    if j['parent'] == name:
+                        order.append(j)
+                        frontier.append(j['child'])
+            joints = order
+
+        self.n = len(joints)
+        self.names = [j['name'] for j in joints]
+        self.links = [j['child'] for j in joints]
+        self.parent = [self.links.index(j['parent']) if j['parent'] in self.links else -1 for j in joints]
+        self.axis = np.array([j['axis'] for j in joints])  # joint axes, each in its own link frame
+        self.R_tree = np.array([rpy2mat(j['rpy']) for j in joints])  # joint frames in their parent frames
+        self.p_tree = np.array([j['xyz'] for j in joints])
+        self.mass = np.array([links[name]['mass'] for name in self.links])
+        self.com = np.array([links[name]['com'] for name in self.links])  # link COMs in link frames
+
+        # link orientation in the parent frame is E0 + sin(q)*E1 + (1 - cos(q))*E2 (Rodrigues),
+        # the spatial transform from the parent is likewise X0 + sin(q)*X1 + (1 - cos(q))*X2
+        K = np.array([skew(a) for a in self.axis])
+        self.E_q = np.array([self.R_tree, np.matmul(self.R_tree, K), np.matmul(self.R_tree, np.matmul(K, K))])
+        self.X_q = np.zeros((3, self.n, 6, 6))
+        for E, X in zip(self.E_q, self.X_q):
+            E_T = np.swapaxes(E, 1, 2)
+            X[:, 0:3, 0:3] = E_T
+            X[:, 3:6, 3:6] = E_T
+            X[:, 3:6, 0:3] = -np.matmul(E_T, np.array([skew(r) for r in self.p_tree]))
+        self.S = np.zeros((self.n, 6))  # joint motion subspaces
+        self.S[:, 0:3] = self.axis
+        self.I = np.zeros((self.n, 6, 6))  # spatial inertias about the link frame origins
+        for i, name in enumerate(self.links):
+            m = self.mass[i]
+            C = skew(self.com[i])
+            self.I[i, 0:3, 0:3] = links[name]['inertia'] + m * np.dot(C, C.T)
+            self.I[i, 0:3, 3:6] = m * C
+            self.I[i, 3:6, 0:3] = m * C.T
+            self.I[i, 3:6, 3:6] = m * np.eye(3)
+
+        # preallocated, overwritten on every call
+        n = self.n
+        self.q = None  # configuration the kinematics below were computed for
+        self.X = np.zeros((n, 6, 6))  # spatial transforms from parent to link coordinates
+        self.R = np.zeros((n, 3, 3))  # link orientations in the base frame
+        self.p = np.zeros((n, 3))  # link origins in the base frame
+        self.z = np.zeros((n, 3))  # joint axes in the base frame
+        self.v = np.zeros((n, 6))
+        self.a = np.zeros((n, 6))
+        self.f = np.zeros((n, 6))
+        self.IC = np.zeros((n, 6, 6))
+        self.H = np.zeros((n, n))
+        self.tau = np.zeros(n)
+        self.E = np.zeros((3, 3))
+        self.F = np.zeros(6)
+        self.Iv = np.zeros(6)
+        self.XI = np.zeros((6, 6))
+
+    def update(self, q):
+        # link transforms at configuration q
+        if self.q is not None and np.array_equal(q, self.q):
+            return
+        self.q = np.array(q, dtype=float)
+        for i in range(self.n):
+            sq = np.sin(self.q[i])
+            cq = 1 - np.cos(self.q[i])
+            E0, E1, E2 = self.E_q[:, i]
+            np.multiply(E1, sq, out=self.E)  # link orientation in the parent frame
+            self.E += E0
+            self.E += cq * E2
+            X0, X1, X2 = self.X_q[:, i]
+            X = self.X[i]
+            np.multiply(X1, sq, out=X)
+            X += X0
+            X += cq * X2
+
+            k = self.parent[i]
+            if k < 0:
+                self.R[i] = self.E
+                self.p[i] = self.p_tree[i]
+            else:
+                np.dot(self.R[k], self.E, out=self.R[i])
+                np.dot(self.R[k], self.p_tree[i], out=self.p[i])
+                self.p[i] += self.p[k]
+            np.dot(self.R[i], self.axis[i], out=self.z[i])
+
+    def rnea(self, q, dq, ddq, gravity=None, out=None):
+        """
+        Inverse dynamics, tau = H(q)*ddq + C(q, dq)*dq + g(q)
+        :param gravity: gravity vector in the base frame, none if None
+        """
+        self.update(q)
+        tau = self.tau if out is None else out
+        a0 = np.zeros(6)
+        if gravity is not None:
+            a0[3:6] = -np.asarray(gravity)  # accelerating the base upward stands in for gravity
+
+        for i in range(self.n):
+            k = self.parent[i]
+            X = self.X[i]
+            S = self.S[i]
+            vJ = S * dq[i]
+            if k < 0:
+                self.v[i] = vJ
+                np.dot(X, a0, out=self.a[i])
+            else:
+                np.dot(X, self.v[k], out=self.v[i])
+                self.v[i] += vJ
+                np.dot(X, self.a[k], out=self.a[i])
+            self.a[i] += S * ddq[i] + crm(self.v[i], vJ)
+            np.dot(self.I[i], self.v[i], out=self.Iv)
+            np.dot(self.I[i], self.a[i], out=self.f[i])
+            self.f[i] += crf(self.v[i], self.Iv)
+
+        for i in reversed(range(self.n)):
+            tau[i] = np.dot(self.S[i], self.f[i])
+            k = self.parent[i]
+            if k >= 0:
+                self.f[k] += np.dot(self.X[i].T, self.f[i])
+
+        return tau
+
+    def ctdq(self, q, dq, out=None):
+        """
+        C(q, dq).T*dq, the gradient of the kinetic energy in q. Moving q_i changes the velocity of link i by
+        -S_i x v_i, and that of every link below it by the same, carried along. So each entry is the momentum
+        of the subtree of link i, in link i coordinates, dotted with v_i x S_i.
+        """
+        self.update(q)
+        ctdq = np.zeros(self.n) if out is None else out
+        for i in range(self.n):
+            k = self.parent[i]
+            if k < 0:
+                np.multiply(self.S[i], dq[i], out=self.v[i])
+            else:
+                np.dot(self.X[i], self.v[k], out=self.v[i])
+                self.v[i] += self.S[i] * dq[i]
+            np.dot(self.I[i], self.v[i], out=self.f[i])  # momentum, summed over the subtree below
+
+        for i in reversed(range(self.n)):
+            ctdq[i] = np.dot(self.f[i], crm(self.v[i], self.S[i]))
+            k = self.parent[i]
+            if k >= 0:
+                self.f[k] += np.dot(self.X[i].T, self.f[i])
+
+        return ctdq
+
+    def crba(self, q, out=None):
+        # joint space mass matrix H(q)
+        self.update(q)
+        H = self.H if out is None else out
+        self.IC[:] = self.I
+        for i in reversed(range(self.n)):
+            k = self.parent[i]
+            if k >= 0:
+                np.dot(self.X[i].T, self.IC[i], out=self.XI)
+                self.IC[k] += np.dot(self.XI, self.X[i])
+
+        H.fill(0)
+        for i in range(self.n):
+            np.dot(self.IC[i], self.S[i], out=self.F)
+            H[i, i] = np.dot(self.S[i], self.F)
+            j = i
+            F = self.F
+            while self.parent[j] >= 0:
+                F = np.dot(self.X[j].T, F)
+                j = self.parent[j]
+                H[i, j] = H[j, i] = np.dot(self.S[j], F)
+
+        return H
+
+    def point_acceleration(self, i, r, out=None):
+        """
+        Acceleration [linear, angular] of point r, given in the frame of link i, in the base frame, from the
+        velocities and accelerations of the last rnea. After rnea with ddq = 0 and no gravity that is Jdot*dq.
+        """
+        acc = np.zeros(6) if out is None else out
+        r = np.asarray(r).tolist()
+        w, v_o = self.v[i, 0:3].tolist(), self.v[i, 3:6].tolist()
+        w_d, a_o = self.a[i, 0:3].tolist(), self.a[i, 3:6].tolist()
+        v_r = [x + y for x, y in zip(v_o, cross(w, r))]
+        a_r = [x + y + z for x, y, z in zip(a_o, cross(w_d, r), cross(w, v_r))]
+        np.dot(self.R[i], a_r, out=acc[0:3])
+        np.dot(self.R[i], w_d, out=acc[3:6])
+        return acc
+
+    def point(self, i, r):
+        # base frame position of point r given in the frame of link i
+        return np.dot(self.R[i], r) + self.p[i]
+
+    def jacobian(self, i, r, q=None, out=None):
+        """
+        Geometric Jacobian of point r, given in the frame of link i, in the base frame.
+        Rows are [linear, angular] velocity, columns of joints that don't move link i are zero.
+        """
+        if q is not None:
+            self.update(q)
+        J = np.zeros((6, self.n)) if out is None else out
+        J.fill(0)
+        x = self.point(i, r).tolist()
+        z = self.z.tolist()
+        p = self.p.tolist()
+        j = i
+        while j >= 0:
+            J[0:3, j] = cross(z[j], [x[0] - p[j][0], x[1] - p[j][1], x[2] - p[j][2]])
+            J[3:6, j] = z[j]
+            j = self.parent[j]
+        return J
+
+
+def parse(path):
+    """
+    Reads links and joints from a URDF.
+    :return: links as {name: {mass, com, inertia}}, inertia about the COM in the link frame,
+    and joints as a list of {name, parent, child, xyz, rpy, axis}
+    """
+    robot = ET.parse(path).getroot()
+
+    def vector(element, attribute, default):
+        if element is None or element.get(attribute) is None:
+            return np.array(default, dtype=float)
+        return np.array(element.get(attribute).split(), dtype=float)
+
+    links = {}
+    for link in robot.findall('link'):
+        inertial = link.find('inertial')
+        if inertial is None:
+            links[link.get('name')] = {'mass': 0., 'com': np.zeros(3), 'inertia': np.zeros((3, 3))}
+            continue
+        origin = inertial.find('origin')
+        i = inertial.find('inertia')
+        ixx, ixy, ixz, iyy, iyz, izz = [float(i.get(k)) for k in ('ixx', 'ixy', 'ixz', 'iyy', 'iyz', 'izz')]
+        inertia = np.array([[ixx, ixy, ixz],
+                            [ixy, iyy, iyz],
+                            [ixz, iyz, izz]])
+        R = rpy2mat(vector(origin, 'rpy', [0, 0, 0]))
+        links[link.get('name')] = {'mass': float(inertial.find('mass').get('value')),
+                                   'com': vector(origin, 'xyz', [0, 0, 0]),
+                                   'inertia': np.dot(R, np.dot(inertia, R.T))}
+
+    joints = []
+    for joint in robot.findall('joint'):
+        if joint.get('type') not in ('revolute', 'continuous'):
+            raise ValueError("joint " + joint.get('name') + " of type " + joint.get('type') + " is not supported")
+        origin = joint.find('origin')
+        axis = vector(joint.find('axis'), 'xyz', [1, 0, 0])
+        joints.append({'name': joint.get('name'),
+                       'parent': joint.find('parent').get('link'),
+                       'child': joint.find('child').get('link'),
+                       'xyz': vector(origin, 'xyz', [0, 0, 0]),
+                       'rpy': vector(origin, 'rpy', [0, 0, 0]),
+                       'axis': axis / np.linalg.norm(axis)})
+
+    return links, joints
+
+
+def rpy2mat(rpy):
+    # URDF fixed axis roll, pitch, yaw: R = Rz(yaw)*Ry(pitch)*Rx(roll)
+    r, p, y = rpy
+    cr, sr, cp, sp, cy, sy = np.cos(r), np.sin(r), np.cos(p), np.sin(p), np.cos(y), np.sin(y)
+    return np.array([[cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr],
+                     [sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr],
+                     [-sp, cp * sr, cp * cr]])
+
+
+def skew(r):
+    # cross product matrix, skew(a)*b = a x b
+    return np.array([[0, -r[2], r[1]],
+                     [r[2], 0, -r[0]],
+                     [-r[1], r[0], 0]])
+
+
+def cross(a, b):
+    # a x b for two 3-vectors as lists, np.cross is slow for a single pair
+    return [a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]]
+
+
+def crm(v, m):
+    # spatial motion cross product v x m
+    v = v.tolist()
+    m = m.tolist()
+    w, u = v[0:3], v[3:6]
+    ang = cross(w, m[0:3])
+    lin = [x + y for x, y in zip(cross(w, m[3:6]), cross(u, m[0:3]))]
+    return np.array(ang + lin)
+
+
+def crf(v, f):
+    # spatial force cross product v x* f
+    v = v.tolist()
+    f = f.tolist()
+    w, u = v[0:3], v[3:6]
+    ang = [x + y for x, y in zip(cross(w, f[0:3]), cross(u, f[3:6]))]
+    return np.array(ang + cross(w, f[3:6]))
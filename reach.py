@@ -0,0 +1,147 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+
+import numpy as np
+
+import codegen
+
+
+class Reach:
+
+    def __init__(self, leg, res=5e-3, phi=0):
+        """
+        Reachable workspace of the end effector of a leg, with the toe at angle phi as in Leg.inv_kinematics.
+        q0 only rotates the leg plane about x, so the workspace is a grid over (x, r) in that plane,
+        r = sqrt(y**2 + z**2), plus the range of q0. The grid is sampled from Leg.position over the joint
+        limits and saved in codegen.cache_dir, together with a sampled point in each reachable cell and the
+        nearest reachable cell of every cell. Cells closer than L0 to the q0 axis are left out: the foot is
+        folded under the hip there, and q0 barely moves it.
+        :param res: grid cell size (m)
+        """
+        self.leg = leg  # for checking clamped targets with its inv_kinematics
+        self.phi = phi
+        self.res = res
+        self.q0_min = leg.q_min[0]
+        self.q0_max = leg.q_max[0]
+        self.reach = np.sum(leg.L)
+        self.x0 = -self.reach  # grid origin, x in [-reach, reach], r in [0, reach]
+        self.shape = (int(np.ceil(2 * self.reach / res)) + 1, int(np.ceil(self.reach / res)) + 1)
+
+        key = [np.asarray(leg.L).tolist(), leg.q_min.tolist(), leg.q_max.tolist(), res, phi,
+               codegen.source_hash(__file__)]
+        path = os.path.join(codegen.cache_dir, 'reach_' + codegen.key_hash(key) + '.npz')
+        if os.path.isfile(path):
+            data = np.load(path)
+            self.reachable = data['reachable']
+            self.near = data['near']
+            self.point = data['point']
+        else:
+            self.reachable, self.near, self.point = self.build(leg, phi)
+            os.makedirs(codegen.cache_dir, exist_ok=True)
+            tmp = path + '.' + str(os.getpid()) + '.npz'  # so parallel runs don't collide
+            np.savez(tmp, reachable=self.reachable, near=self.near, point=self.point)
+            os.replace(tmp, path)
+
+        # sampled points on the edge of the workspace, for targets outside the grid
+        self.edge = self.point[edge(self.reachable)]
+
+    def build(self, leg, phi):
+        # mark every cell hit by sampling q1, q2 at steps of under half a cell at full reach
+        n1 = int((leg.q_max[1] - leg.q_min[1]) * 2 * self.reach / self.res) + 1
+        n2 = int((leg.q_max[2] - leg.q_min[2]) * 2 * self.reach / self.res) + 1
+        q1, q2 = np.meshgrid(np.linspace(leg.q_min[1], leg.q_max[1], n1),
+                             np.linspace(leg.q_min[2], leg.q_max[2], n2), indexing='ij')
+        q = np.zeros((q1.size, 4))
+        q[:, 1] = q1.ravel()
+        q[:, 2] = q2.ravel()
+        q[:, 3] = phi - q[:, 1] - q[:, 2]
+        q = q[(q[:, 3] >= leg.q_min[3]) & (q[:, 3] <= leg.q_max[3])]  # q0 = 0 puts the leg plane on x-y
+
+        reachable = np.zeros(self.shape, dtype=bool)
+        point = np.zeros(self.shape + (2,))  # (x, r) of a sample that landed in each reachable cell
+        for i in range(0, len(q), 100000):
+            p = leg.position(q[i:i + 100000])[:, :, -1]
+            i_x = np.floor((p[:, 0] - self.x0) / self.res + 0.5).astype(int)
+            i_r = np.floor(p[:, 1] / self.res + 0.5).astype(int)
+            ok = (p[:, 1] >= leg.L[0]) & (i_r < self.shape[1])  # the leg folded under the hip is left out
+            reachable[i_x[ok], i_r[ok]] = True
+            point[i_x[ok], i_r[ok]] = p[ok, 0:2]
+
+        # nearest reachable cell to each cell, it only ever lies on the edge of the reachable set
+        edges = np.flatnonzero(edge(reachable))
+        e_x, e_r = np.unravel_index(edges, self.shape)
+        near = np.arange(reachable.size)
+        out = np.flatnonzero(~reachable)
+        for i in range(0, len(out), 4096):
+            c_x, c_r = np.unravel_index(out[i:i + 4096], self.shape)
+            d = (c_x[:, None] - e_x) ** 2 + (c_r[:, None] - e_r) ** 2
+            near[out[i:i + 4096]] = edges[np.argmin(d, axis=1)]
+        return reachable, near.reshape(self.shape), point
+
+    def cell(self, xyz):
+        # grid indices and plane coordinates of end effector positions, (3,) or (N, 3)
+        # indices of targets outside the grid are clipped to it, inside is False for them
+        xyz = np.asarray(xyz, dtype=float)
+        r = np.sqrt(xyz[..., 1] ** 2 + xyz[..., 2] ** 2)
+        i_x = np.floor((xyz[..., 0] - self.x0) / self.res + 0.5).astype(int)
+        i_r = np.floor(r / self.res + 0.5).astype(int)
+        inside = (i_x >= 0) & (i_x < self.shape[0]) & (i_r < self.shape[1])
+        i_x = np.clip(i_x, 0, self.shape[0] - 1)
+        i_r = np.clip(i_r, 0, self.shape[1] - 1)
+        return i_x, i_r, r, inside
+
+    def is_reachable(self, xyz):
+        xyz = np.asarray(xyz, dtype=float)
+        i_x, i_r, r, inside = self.cell(xyz)
+        q0 = np.arctan2(xyz[..., 2], xyz[..., 1])
+        return inside & self.reachable[i_x, i_r] & (q0 >= self.q0_min) & (q0 <= self.q0_max)
+
+    def clamp(self, xyz):
+        """
+        Moves end effector positions relative to the leg base, (3,) or (N, 3), that are outside the workspace
+        to the sampled point of the nearest reachable cell. q0 is clamped to its range first, targets on the
+        q0 axis get the middle of it. Targets in a reachable cell are kept if Leg.inv_kinematics reaches
+        them, otherwise they also go to the cell's sampled point, so the result is always reachable (to the
+        1e-9 joint limit tolerance of inv_kinematics) and moves by at most about one cell (res) from a
+        target in a reachable cell. Targets outside the grid go to the nearest edge point, which is a search
+        over the edge rather than a lookup, they are only expected from bad plans.
+        """
+        xyz = np.array(xyz, dtype=float)
+        i_x, i_r, r, inside = self.cell(xyz)
+        q0 = np.arctan2(xyz[..., 2], xyz[..., 1])
+        q0 = np.clip(np.where(r > 1e-9, q0, (self.q0_min + self.q0_max) / 2), self.q0_min, self.q0_max)
+        ok = inside & self.reachable[i_x, i_r]
+        p = self.point.reshape(-1, 2)[self.near[i_x, i_r]]
+        if not np.all(inside):
+            outside = ~inside
+            d = ((xyz[outside][..., 0:1] - self.edge[:, 0]) ** 2 + (r[outside][..., None] - self.edge[:, 1]) ** 2)
+            p[outside] = self.edge[np.argmin(d, axis=-1)]
+        # targets in a reachable cell that inv_kinematics can't reach go to the cell's sampled point too
+        kept = np.stack([xyz[..., 0], r * np.cos(q0), r * np.sin(q0)], axis=-1)
+        ok &= self.leg.inv_kinematics(kept, self.phi)[1]
+        r = np.where(ok, r, p[..., 1])
+        xyz[..., 0] = np.where(ok, xyz[..., 0], p[..., 0])
+        xyz[..., 1] = r * np.cos(q0)
+        xyz[..., 2] = r * np.sin(q0)
+        return xyz
+
+
+def edge(reachable):
+    # reachable cells with an unreachable 4-neighbour or on the border of the grid
+    inside = np.pad(reachable, 1, constant_values=False)
+    return reachable & ~(inside[:-2, 1:-1] & inside[2:, 1:-1] & inside[1:-1, :-2] & inside[1:-1, 2:])
@@ -17,8 +17,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import contact
 import simulationbridge
 import leg
+import reach
 import wbc
+import wbic
 import mpc
+import mpcworker
+import mpcscheduler
 import statemachine
 import qp
 import gait
@@ -36,9 +40,17 @@ np.set_printoptions(suppress=True, linewidth=np.nan)
 
 class Runner:
 
-    def __init__(self, dt=1e-3):
+    def __init__(self, dt=1e-3, mpc_async=False, mpc_dt=0.025, mpc_event=True, wbic_control=False,
+                 wbc_fused=False, mpc_budget=None):
 
         self.dt = dt
+        self.mpc_async = mpc_async  # solve the MPC in a background process instead of inside the tick
+        # wall time budget (s) for the MPC solve inside the tick, the solve then also runs in a background process
+        # so it can be given up on, None to wait for every solve
+        self.mpc_budget = mpc_budget
+        self.mpc_dt = mpc_dt  # mpc period, can be longer than the MPC step since the whole plan is used
+        # re-solve at once on gait state changes and state error jumps, stretch the period in between
+        self.mpc_schedule = mpcscheduler.MpcScheduler(mpc_dt=mpc_dt, event=mpc_event)
         self.u_l = np.zeros(4)
         self.u_r = np.zeros(4)
 
@@ -47,10 +59,22 @@ class Runner:
 
         self.leg_left = leg.Leg(dt=dt, leg=left)
         self.leg_right = leg.Leg(dt=dt, leg=right)
+        self.reach = reach.Reach(self.leg_left)  # both legs have the same workspace about their hips
         controller_class = wbc
         self.controller_left = controller_class.Control(dt=dt)
         self.controller_right = controller_class.Control(dt=dt)
-        self.force = mpc.Mpc(dt=dt)
+        # one floating base QP for both legs instead of the two per-leg controllers
+        self.wbic = wbic.Wbic(dt=dt) if wbic_control is True else None
+        # both per-leg controllers computed as one batched step, the same control signals
+        self.wbc_fused = wbc.Fused((self.controller_left, self.controller_right)) if wbc_fused is True else None
+        if self.mpc_async is True:
+            self.force = mpcworker.MpcWorker(dt=dt)
+            self.force.start()
+        elif self.mpc_budget is not None:
+            self.force = mpcworker.MpcWorker(t_budget=self.mpc_budget, dt=dt)
+            self.force.start()
+        else:
+            self.force = mpc.Mpc(dt=dt)
         self.contact_left = contact.Contact(leg=self.leg_left, dt=dt)
         self.contact_right = contact.Contact(leg=self.leg_right, dt=dt)
         self.simulator = simulationbridge.Sim(dt=dt)
@@ -102,9 +126,8 @@ class Runner:
         prev_contact_r = False
 
         mpc_force = np.zeros(6)
-        mpc_dt = 0.025  # mpc period
-        mpc_factor = mpc_dt / self.dt  # repeat mpc every x seconds
-        mpc_counter = mpc_factor
+        mpc_t = np.zeros(1)  # start time of each step of the force plan
+        mpc_plan = np.zeros((1, 6))  # force plan, one row per step
         skip = False
         t_prev = time.clock()
         time.sleep(self.dt)
@@ -145,8 +168,8 @@ class Runner:
             state_r = self.state_right.FSM.execute(s_r, sh_r)
             # print(state_l, sh_l, self.dist_force_l[2])
             # forward kinematics
-            pos_l = np.dot(b_orient, self.leg_left.position()[:, -1])
-            pos_r = np.dot(b_orient, self.leg_right.position()[:, -1])
+            pos_l = np.dot(b_orient, self.leg_left.x_ee)
+            pos_r = np.dot(b_orient, self.leg_right.x_ee)
 
             pdot = np.array(self.simulator.v)  # base linear velocity in global Cartesian coordinates
             p = p + pdot * self.dt  # body position in world coordinates
@@ -186,44 +209,89 @@ class Runner:
 
             x_ref = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]).T  # reference pose (desired)
 
-            if mpc_counter == mpc_factor:  # check if it's time to restart the mpc
-                if np.linalg.norm(x_in - x_ref) > 1e-2:  # then check if the error is high enough to warrant it
-                    mpc_force = self.force.mpcontrol(rz_phi=rz_phi, r1=pos_l, r2=pos_r, x_in=x_in, x_ref=x_ref,
-                                                     c_l=contact_l, c_r=contact_r)
-                    # print("force = ", mpc_force)
-                    skip = False
+            # check if it's time to restart the mpc, and if the error is high enough to warrant it
+            mpc_solve, mpc_skip = self.mpc_schedule.due(t=t, states=(state_l, state_r), x_in=x_in, x_ref=x_ref)
+            if mpc_solve is True:
+                if self.mpc_async is True:
+                    # hand the latest state to the worker, the solution is picked up below when ready
+                    self.force.request(t=t, rz_phi=rz_phi, r1=pos_l, r2=pos_r, x_in=x_in, x_ref=x_ref,
+                                       c_l=contact_l, c_r=contact_r)
                 else:
-                    skip = True  # tells gait ctrlr to default to position control.
-                    print("skipping mpc")
-                mpc_counter = 0
-
-            mpc_counter += 1
+                    mpc_t, mpc_plan = self.force.mpcontrol(rz_phi=rz_phi, r1=pos_l, r2=pos_r, x_in=x_in,
+                                                           x_ref=x_ref, c_l=contact_l, c_r=contact_r, t=t)
+                # print("force = ", mpc_force)
+                skip = False
+            elif mpc_skip is True:
+                skip = True  # tells gait ctrlr to default to position control.
+                print("skipping mpc")
+
+            if self.mpc_async is True:
+                mpc_new = self.force.latest()  # never waits, None if no new solution has arrived
+                if mpc_new is not None:
+                    mpc_t, mpc_plan = mpc_new
+
+            # feedforward force for this tick from the step of the plan we are in, holding the last one past the end
+            mpc_force = mpc_plan[np.clip(np.searchsorted(mpc_t, t, side='right') - 1, 0, len(mpc_t) - 1)]
 
             if self.force_control_test is True:
                 state_l = 'stance'
                 state_r = 'stance'
                 mpc_force = np.zeros(6)
 
-            # calculate wbc control signal
-            self.u_l = self.gait_left.u(state=state_l, prev_state=prev_state_l, r_in=pos_l, r_d=self.r_l,
-                                        b_orient=b_orient, fr_mpc=mpc_force[0:3], skip=skip)
-            # just standing for now
-            self.u_r = self.gait_right.u(state=state_r, prev_state=prev_state_r, r_in=pos_r, r_d=self.r_r,
-                                         b_orient=b_orient, fr_mpc=mpc_force[3:], skip=skip)
+            if self.wbic is not None:
+                target_l = self.gait_left.plan(state=state_l, prev_state=prev_state_l, r_in=pos_l, r_d=self.r_l)
+                target_r = self.gait_right.plan(state=state_r, prev_state=prev_state_r, r_in=pos_r, r_d=self.r_r)
+                stance_l = state_l == 'stance' or state_l == 'early'
+                stance_r = state_r == 'stance' or state_r == 'early'
+                tau_l, tau_r = self.wbic.wbic_control(leg_l=self.leg_left, leg_r=self.leg_right,
+                                                      target_l=target_l, target_r=target_r, b_orient=b_orient,
+                                                      force_l=mpc_force[0:3] if stance_l and not skip else None,
+                                                      force_r=mpc_force[3:] if stance_r and not skip else None,
+                                                      c_l=stance_l, c_r=stance_r)
+                self.u_l = -tau_l
+                self.u_r = -tau_r
+                Mq_l, Mq_r = self.wbic.Mq
+                grav_l, grav_r = self.wbic.grav
+            elif self.wbc_fused is not None:
+                target_l = self.gait_left.plan(state=state_l, prev_state=prev_state_l, r_in=pos_l, r_d=self.r_l)
+                target_r = self.gait_right.plan(state=state_r, prev_state=prev_state_r, r_in=pos_r, r_d=self.r_r)
+                force_l = self.gait_left.force(state=state_l, fr_mpc=mpc_force[0:3], skip=skip)
+                force_r = self.gait_right.force(state=state_r, fr_mpc=mpc_force[3:], skip=skip)
+                u = self.wbc_fused.wb_control(legs=(self.leg_left, self.leg_right), targets=(target_l, target_r),
+                                              b_orient=b_orient, forces=(force_l, force_r))
+                self.u_l = -u[0]
+                self.u_r = -u[1]
+                Mq_l = self.controller_left.Mq
+                Mq_r = self.controller_right.Mq
+                grav_l = self.controller_left.grav
+                grav_r = self.controller_right.grav
+            else:
+                # calculate wbc control signal
+                self.u_l = self.gait_left.u(state=state_l, prev_state=prev_state_l, r_in=pos_l, r_d=self.r_l,
+                                            b_orient=b_orient, fr_mpc=mpc_force[0:3], skip=skip)
+                # just standing for now
+                self.u_r = self.gait_right.u(state=state_r, prev_state=prev_state_r, r_in=pos_r, r_d=self.r_r,
+                                             b_orient=b_orient, fr_mpc=mpc_force[3:], skip=skip)
+                Mq_l = self.controller_left.Mq
+                Mq_r = self.controller_right.Mq
+                grav_l = self.controller_left.grav
+                grav_r = self.controller_right.grav
 
             # receive disturbance torques
-            dist_tau_l = self.contact_left.disturbance_torque(Mq=self.controller_left.Mq,
+            dist_tau_l = self.contact_left.disturbance_torque(Mq=Mq_l,
                                                               dq=self.leg_left.dq,
                                                               tau_actuated=-self.u_l,
-                                                              grav=self.controller_left.grav)
-            dist_tau_r = self.contact_right.disturbance_torque(Mq=self.controller_right.Mq,
+                                                              grav=grav_l,
+                                                              CTdq=self.leg_left.CTdq)
+            dist_tau_r = self.contact_right.disturbance_torque(Mq=Mq_r,
                                                                dq=self.leg_right.dq,
                                                                tau_actuated=-self.u_r,
-                                                               grav=self.controller_right.grav)
+                                                               grav=grav_r,
+                                                               CTdq=self.leg_right.CTdq)
             # convert disturbance torques to forces
-            self.dist_force_l = np.dot(np.linalg.pinv(np.transpose(self.leg_left.gen_jacEE()[0:3])),
+            self.dist_force_l = np.dot(np.linalg.pinv(np.transpose(self.leg_left.JEE[0:3])),
                                        np.array(dist_tau_l))
-            self.dist_force_r = np.dot(np.linalg.pinv(np.transpose(self.leg_right.gen_jacEE()[0:3])),
+            self.dist_force_r = np.dot(np.linalg.pinv(np.transpose(self.leg_right.JEE[0:3])),
                                        np.array(dist_tau_r))
             # print(self.dist_force_l[2], self.dist_force_r[2])
             prev_state_l = state_l
@@ -289,4 +357,6 @@ class Runner:
         # print("p_symmetry = ", p_symmetry, robotleg)
         # print("p = ", p, robotleg)
         p[2] = -0.8325  # assume constant height for now. TODO: height changes?
+        # keep the footstep inside the workspace of the leg, relative to the hip in the yaw frame
+        p = p_hip + np.dot(rz_phi, self.reach.clamp(np.dot(rz_phi.T, p - p_hip)))
         return p
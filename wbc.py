@@ -18,9 +18,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 
 import numpy as np
-import transforms3d
 
 import control
+import quat
 
 
 class Control(control.Control):
@@ -73,7 +73,10 @@ class Control(control.Control):
         self.x = None
         self.grav = None
         self.velocity = None
-        self.q_e = None
+        self.q_e = np.zeros(4)  # end effector orientation
+        self.q_d = np.zeros(4)  # target orientation, only recomputed when the target angles change
+        self.q_r = np.zeros(4)  # rotation from q_e to q_d
+        self.euler_d = None  # target angles q_d was computed from
         self.ctrlr_dof = np.array([True, True, True, False, False, False])
 
     def wb_control(self, leg, target, b_orient, force, x_dd_des=None):
@@ -90,18 +93,18 @@ class Control(control.Control):
         # which dim to control of [x, y, z, alpha, beta, gamma]
         ctrlr_dof = self.ctrlr_dof
 
-        # calculate the Jacobian
-        JEE = leg.gen_jacEE()[ctrlr_dof]  # print(np.linalg.matrix_rank(JEE))
+        # the Jacobian and mass matrix from this tick's kinematic snapshot, see Leg.update_kinematics
+        JEE = leg.JEE[ctrlr_dof]  # print(np.linalg.matrix_rank(JEE))
         # rank of matrix is 3, can only control 3 DOF with one OSC
 
         # generate the mass matrix in end-effector space
-        self.Mq = leg.gen_Mq()
-        Mx = leg.gen_Mx(Mq=self.Mq, JEE=JEE)
+        self.Mq = leg.Mq
+        Mx = leg.gen_Mx(Mq=self.Mq, JEE=JEE, rows=ctrlr_dof)
 
         x_dd_des = np.zeros(6)  # [x, y, z, alpha, beta, gamma]
 
         # multiply with rotation matrix for base to world
-        self.x = np.dot(b_orient, leg.position()[:, -1])  # select last position value to get EE xyz
+        self.x = np.dot(b_orient, leg.x_ee)  # select last position value to get EE xyz
         # self.x = leg.position()[:, -1]
 
         # calculate operational space velocity vector
@@ -112,18 +115,16 @@ class Control(control.Control):
 
         # Orientation-Control------------------------------------------------------------------------------#
         # calculate end effector orientation unit quaternion
-        self.q_e = leg.orientation(b_orient=b_orient)
+        leg.orientation(b_orient=b_orient, out=self.q_e)
 
         # calculate the target orientation unit quaternion
-        q_d = transforms3d.euler.euler2quat(self.target[3], self.target[4], self.target[5], axes='sxyz')
-        q_d = q_d / np.linalg.norm(q_d)  # convert to unit vector quaternion
+        euler_d = (self.target[3], self.target[4], self.target[5])
+        if euler_d != self.euler_d:
+            quat.euler2quat(*euler_d, out=self.q_d)  # static xyz axes
+            self.euler_d = euler_d
 
         # calculate the rotation between current and target orientations
-        q_r = transforms3d.quaternions.qmult(
-            q_d, transforms3d.quaternions.qconjugate(self.q_e))
-        # q_r = transforms3d.quaternions.qmult(
-        #     q_r, transforms3d.euler.euler2quat(-np.pi/2, 0, 0, axes='sxyz'))
-        # self.q_r = q_r
+        q_r = quat.mult_conj(self.q_d, self.q_e, out=self.q_r)
         # convert rotation quaternion to Euler angle forces
         x_dd_des[3:] = np.dot(self.ko, q_r[1:] * np.sign(q_r[0]))
         # x_dd_des[3:] = np.dot(self.ko, transforms3d.euler.quat2euler(q_r, axes='rxyz'))
@@ -132,12 +133,13 @@ class Control(control.Control):
         x_dd_des = x_dd_des[ctrlr_dof]  # get rid of dim not being controlled
 
         x_dd_des = np.reshape(x_dd_des, (-1, 1))
+        x_dd_des -= np.reshape(leg.JEEdot_dq[ctrlr_dof], (-1, 1))  # x_dd = JEE*q_dd + JEE_dot*dq
 
         # calculate force
         Fx = np.dot(Mx, x_dd_des)
         Aq_dd = (np.dot(JEE.T, Fx).reshape(-1, ))
 
-        self.grav = leg.gen_grav(b_orient=b_orient)
+        self.grav = leg.gen_grav(b_orient=b_orient, out=self.grav)  # reuses the array from the last tick
 
         if force is None:
             force_control = 0
@@ -145,7 +147,7 @@ class Control(control.Control):
             Fr = np.dot(b_orient, force)
             force_control = (np.dot(JEE.T, Fr).reshape(-1, ))
         # print(force_control)
-        self.u = Aq_dd - self.grav - force_control*20
+        self.u = Aq_dd + leg.Cdq - self.grav - force_control*20
 
         self.x_dd_des = x_dd_des
         self.Mx = Mx
@@ -165,10 +167,10 @@ class Control(control.Control):
             q_des = (np.dot(self.kn, prop_val))
             #        + np.dot(self.knd, -leg.dq.reshape(-1, )))
 
-            Fq_null = np.dot(Mq, q_des)
+            Fq_null = np.dot(self.Mq, q_des)
 
-            # calculate the null space filter
-            Jdyn_inv = np.dot(Mx, np.dot(JEE, np.linalg.inv(Mq)))
+            # calculate the null space filter, from the factorization of Mq in gen_Mx
+            Jdyn_inv = leg.gen_Jdyn_inv(Mx)
 
             null_filter = np.eye(len(leg.L)) - np.dot(JEE.T, Jdyn_inv)
 
@@ -178,7 +180,7 @@ class Control(control.Control):
 
         if self.leveler:
             # keeps ee pitch level
-            base_y = transforms3d.euler.mat2euler(b_orient, axes='ryxz')[0]  # get y axis rotation of base
+            base_y = quat.pitch(self.b_orient)  # get y axis rotation of base
             q1 = leg.q[1]
             q2 = leg.q[2]
             # keep ee level
@@ -192,3 +194,101 @@ class Control(control.Control):
             self.u += addition.generate(self.u, leg)
 
         return self.u
+
+
+class Fused:
+
+    def __init__(self, controllers):
+        """
+        Control.wb_control for K legs at once. The state of all legs is stacked into (K, ...) arrays so the
+        Jacobians, operational space mass matrices and PD law run as one batched computation each.
+        Gains are read from the per-leg controllers here, and their Mq, Mx, J, x, velocity, x_dd_des, grav
+        and u are set to views of the stacked results every call, as wb_control would set them.
+        Only the end effector position is controlled, as with the default ctrlr_dof, so the orientation
+        error that wb_control computes and drops is left out.
+        """
+        for c in controllers:
+            if np.any(c.ctrlr_dof[3:]) or not np.all(c.ctrlr_dof[0:3]):
+                raise ValueError("Fused only controls the end effector position, ctrlr_dof must be xyz")
+            if c.null_control:
+                raise ValueError("Fused does not support null_control")
+        self.controllers = controllers
+        self.kp = np.array([c.kp for c in controllers])  # (K, 3, 3)
+        self.kv = np.array([c.kv for c in controllers])
+
+        self.Mx = None
+        self.u = None
+
+    def gen_Mx(self, legs, Mq, JEE):
+        # LegBase.gen_Mx for all legs, with batched Cholesky factorizations and solves
+        try:
+            Mq_chol = np.linalg.cholesky(Mq)
+        except np.linalg.LinAlgError:  # some Mq not positive definite, leave it to the per-leg fallback
+            return np.array([leg.gen_Mx(Mq=Mq[k], JEE=JEE[k]) for k, leg in enumerate(legs)])
+        Mq_chol_JT = np.linalg.solve(Mq_chol, JEE.transpose(0, 2, 1))
+        Mx_inv = np.matmul(Mq_chol_JT.transpose(0, 2, 1), Mq_chol_JT)
+
+        # the same cut off as legbase.inv3: direct inverse where its eigenvalue bound holds, eigh elsewhere
+        thresh = legs[0].singularity_thresh
+        a = Mx_inv[:, 0, 0]
+        tr = a + Mx_inv[:, 1, 1] + Mx_inv[:, 2, 2]
+        det = np.linalg.det(Mx_inv)
+        ok = (a > 0) & (a * Mx_inv[:, 1, 1] - Mx_inv[:, 0, 1] ** 2 > 0) & (det > 0) & (det * 4 >= thresh * tr * tr)
+        if ok.all():
+            return np.linalg.inv(Mx_inv)
+        w, v = np.linalg.eigh(Mx_inv)
+        w_inv = np.divide(1., w, out=np.zeros_like(w), where=w >= thresh)
+        Mx = np.matmul(v * w_inv[:, None, :], v.transpose(0, 2, 1))
+        if ok.any():
+            Mx[ok] = np.linalg.inv(Mx_inv[ok])
+        return Mx
+
+    def wb_control(self, legs, targets, b_orient, forces):
+        """
+        :param legs: the K leg models, from this tick's snapshot
+        :param targets: desired end effector position of each leg, in the world-aligned hip frame
+        :param forces: reaction force for each leg in the world frame, None for no force control
+        :return: (K, 4) control signals, row k the same as controllers[k].wb_control for legs[k]
+        """
+        R = np.array(b_orient)
+        JEE = np.array([leg.JEE[0:3] for leg in legs])  # (K, 3, 4)
+        Mq = np.array([leg.Mq for leg in legs])
+        dq = np.array([leg.dq for leg in legs])
+        Mx = self.gen_Mx(legs, Mq, JEE)
+
+        x = np.dot(np.array([leg.x_ee for leg in legs]), R.T)
+        velocity = np.dot(np.matmul(JEE, dq[:, :, None])[:, :, 0], R.T)
+        target = np.array([t[0:3] for t in targets])
+        x_dd_des = np.matmul(self.kp, (target - x)[:, :, None]) - np.matmul(self.kv, velocity[:, :, None])
+        x_dd_des -= np.array([leg.JEEdot_dq[0:3] for leg in legs])[:, :, None]  # x_dd = JEE*q_dd + JEE_dot*dq
+
+        # u = JEE.T*(Mx*x_dd_des - 20*R*force) + Cdq - grav
+        F = np.matmul(Mx, x_dd_des)[:, :, 0]
+        for k, force in enumerate(forces):
+            if force is not None:
+                F[k] -= np.dot(R, force) * 20
+        u = np.matmul(JEE.transpose(0, 2, 1), F[:, :, None])[:, :, 0]
+
+        # gravity from each leg's own model, so it matches wb_control in every model mode
+        grav = np.zeros((len(legs), 4))
+        for k, leg in enumerate(legs):
+            leg.gen_grav(b_orient=R, out=grav[k])
+        u += np.array([leg.Cdq for leg in legs]) - grav
+
+        for k, (c, leg) in enumerate(zip(self.controllers, legs)):
+            c.target = targets[k]
+            c.b_orient = R
+            c.Mq = Mq[k]
+            c.Mx = Mx[k]
+            c.J = JEE[k]
+            c.x = x[k]
+            c.velocity = velocity[k]
+            c.x_dd_des = x_dd_des[k]
+            c.grav = grav[k]
+            for addition in c.additions:
+                u[k] += addition.generate(u[k], leg)
+            c.u = u[k]
+
+        self.Mx = Mx
+        self.u = u
+        return u
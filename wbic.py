@@ -0,0 +1,245 @@
+"""
+Copyright (C) 2020 Benjamin Bokser
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Reference Material:
+
+Highly Dynamic Quadruped Locomotion via Whole-Body Impulse Control and Model Predictive Control
+Donghyun Kim et al.
+"""
+
+import numpy as np
+
+import casadi as cs
+
+import modeldata
+
+
+class Wbic:
+
+    def __init__(self, dt=1e-3, **kwargs):
+        """
+        Whole body impulse control for both legs at once.
+        The floating base model has generalized velocities [v_base, omega_base, dq_left, dq_right] (14),
+        v_base and omega_base in the world frame. One QP finds the base acceleration, the joint accelerations
+        of both legs and both contact forces closest to the commanded ones that satisfy the floating base
+        rows of the dynamics and the friction cones. The joint torques then follow from the leg rows.
+        """
+        self.dt = dt
+        self.n_base = 6
+        self.n_q = 8  # joints of both legs
+        self.n_v = self.n_base + self.n_q
+        self.n_f = 6  # contact forces of both feet
+        self.mu = 0.5  # coefficient of friction
+        self.gravity = np.array([0, 0, -9.807])
+
+        data = modeldata.load()
+        self.mass_b = data['urdf_mass'][0]  # mass and inertia of the body link, about its COM
+        ixx, ixy, ixz, iyy, iyz, izz = data['urdf_inertia'][0]
+        self.inertia_b = np.array([[ixx, ixy, ixz],
+                                   [ixy, iyy, iyz],
+                                   [ixz, iyz, izz]])  # body inertia tensor in local frame
+
+        # vectors from the body COM to the hip joints in the body frame (x forward, y left), from the URDF
+        names = data['urdf_names'].tolist()
+        com_b = data['urdf_com'][0]
+        self.rh_l = data['urdf_joint_origin'][names.index('left femur')] - com_b
+        self.rh_r = data['urdf_joint_origin'][names.index('right femur')] - com_b
+
+        # foot tasks, same gains as wbc.Control
+        self.kp = np.eye(3) * 2000
+        self.kv = np.eye(3) * 100
+        self.kn = np.diag([0, 0, 0, 10])  # joint posture, keeps the toe level like the wbc leveler
+
+        # QP weights on deviations from the commanded accelerations and forces
+        self.w = np.hstack([np.full(self.n_base, 1.), np.full(self.n_q, 10.), np.full(self.n_f, 1e-3)])
+        self.H = np.diag(2 * self.w)
+
+        fc_k = np.array([[1, 0, -self.mu],  # fx - mu*fz
+                         [-1, 0, -self.mu],  # -fx - mu*fz
+                         [0, 1, -self.mu],  # fy - mu*fz
+                         [0, -1, -self.mu]])  # -fy - mu*fz
+        self.fc = np.kron(np.eye(2), fc_k)
+
+        n_x = self.n_v + self.n_f
+        n_g = self.n_base + len(self.fc)
+        opts = {'print_time': 0, 'error_on_fail': 0, 'printLevel': "none", 'boundTolerance': 1e-6,
+                'terminationTolerance': 1e-6}
+        self.solver = cs.conic('S', 'qpoases', {'h': cs.Sparsity.dense(n_x, n_x),
+                                                'a': cs.Sparsity.dense(n_g, n_x)}, opts)
+        self.lbg = np.hstack([np.zeros(self.n_base), np.full(len(self.fc), -1e10)])
+        self.ubg = np.zeros(n_g)
+
+        # warm start: previous primal/dual solution
+        self.x_prev = np.zeros(n_x)
+        self.lam_x_prev = np.zeros(n_x)
+        self.lam_g_prev = np.zeros(n_g)
+
+        self.R = None  # body orientation
+        self.M = None  # floating base mass matrix
+        self.h = None  # gravity and leg velocity product terms, see gen_model
+        self.Jc = None  # contact Jacobians of both feet
+        self.Mq = [None, None]  # joint space mass matrix of each leg, as wbc.Control.Mq
+        self.grav = [None, None]  # joint space gravity torque of each leg, as wbc.Control.grav
+        self.x_ee = [None, None]  # foot position of each leg relative to its hip, world frame
+        self.JEE = [None, None]  # foot Jacobian of each leg, world frame
+        self.q_dd = None
+        self.f = None
+
+    def gen_model(self, legs, b_orient):
+        """
+        Assembles the floating base mass matrix M, gravity and velocity product term h and the foot contact
+        Jacobians, once per tick, from the kinematic snapshot of both legs.
+        M*dv + h = S.T*tau + Jc.T*f
+        The leg blocks are the joint space mass matrix, gravity and velocity products of each leg about a fixed
+        base (Leg.Mq, Leg.gen_grav, Leg.Cdq). Only the base rows and columns are computed here, from the total
+        mass, first moment and inertia of the links about the body COM and their mass-weighted COM Jacobians.
+        The terms that need the base velocity, the gyroscopic w x I*w of the body and the Coriolis coupling
+        between base and legs, are left out: the base velocity isn't passed in and they are small at walking
+        speeds.
+        """
+        n_v = self.n_v
+        n_base = self.n_base
+        R = np.array(b_orient)
+        self.R = R
+        g = self.gravity
+
+        M = np.zeros((n_v, n_v))
+        h = np.zeros(n_v)
+        Jc = np.zeros((self.n_f, n_v))
+
+        mass = self.mass_b  # totals about the body COM, local frame
+        moment = np.zeros(3)
+        inertia = np.copy(self.inertia_b)
+        for k, (leg, rh) in enumerate(zip(legs, (self.rh_l, self.rh_r))):
+            cols = slice(n_base + 4 * k, n_base + 4 * (k + 1))
+            # kinematics from this tick's snapshot, see Leg.update_kinematics
+            m = leg.mass[0:4]
+            p = rh[:, None] + leg.pos_com  # link COMs relative to the body COM, local frame
+            mp = m * p
+            # base rows of the leg columns, sum(m_i*Jv_i) and sum(m_i*p_i x Jv_i + I_i*Jw_i): the spatial inertia
+            # of each link moved to the body COM, times its COM Jacobian
+            MM = np.array(leg.MM)
+            A = MM.transpose(1, 0, 2).copy()
+            A[3, :, 1] = -mp[2]
+            A[3, :, 2] = mp[1]
+            A[4, :, 0] = mp[2]
+            A[4, :, 2] = -mp[0]
+            A[5, :, 0] = -mp[1]
+            A[5, :, 1] = mp[0]
+            B = np.dot(A.reshape(6, 24), np.concatenate(leg.JCOM))
+            M[0:3, cols] = np.dot(R, B[0:3])
+            M[3:6, cols] = np.dot(R, B[3:6])
+            M[cols, 0:6] = M[0:6, cols].T
+            M[cols, cols] = leg.Mq
+            self.Mq[k] = M[cols, cols]
+
+            self.grav[k] = leg.gen_grav(b_orient=R)
+            h[cols] = leg.Cdq - self.grav[k]  # velocity products of the leg about a fixed base, and gravity
+
+            mass += m.sum()
+            moment += mp.sum(axis=1)
+            inertia += MM[:, 3:6, 3:6].sum(axis=0) - np.dot(mp, p.T)  # parallel axis, sum(m*(|p|^2*I - p*p.T))
+            inertia.flat[::4] += np.vdot(mp, p)
+
+            self.x_ee[k] = np.dot(R, leg.x_ee)
+            self.JEE[k] = np.dot(R, leg.JEE[0:3])
+            Jc[3 * k:3 * (k + 1), 0:3] = np.eye(3)
+            Jc[3 * k:3 * (k + 1), 3:6] = -skew(np.dot(R, rh) + self.x_ee[k])
+            Jc[3 * k:3 * (k + 1), cols] = self.JEE[k]
+
+        moment = np.dot(R, moment)
+        M[0:3, 0:3] = np.eye(3) * mass
+        M[3:6, 0:3] = skew(moment)
+        M[0:3, 3:6] = -M[3:6, 0:3]
+        M[3:6, 3:6] = np.dot(R, np.dot(inertia, R.T))
+        h[0:3] = -mass * g
+        h[3:6] = -np.dot(M[3:6, 0:3], g)  # -moment x g
+
+        self.M = M
+        self.h = h
+        self.Jc = Jc
+        return M, h, Jc
+
+    def q_dd_cmd(self, k, leg, target):
+        # commanded joint accelerations of leg k: foot PD in the world-aligned hip frame, as in wbc.Control,
+        # plus a posture term in the null space of the foot task. Uses the kinematics from gen_model.
+        JEE = self.JEE[k]
+        velocity = np.dot(JEE, leg.dq)
+        x_dd_des = np.dot(self.kp, target[0:3] - self.x_ee[k]) + np.dot(self.kv, -velocity)
+        x_dd_des -= np.dot(self.R, leg.JEEdot_dq[0:3])  # x_dd = JEE*q_dd + JEE_dot*dq
+        try:
+            J_inv = np.dot(JEE.T, np.linalg.inv(np.dot(JEE, JEE.T)))  # pinv of a full row rank JEE, without the SVD
+        except np.linalg.LinAlgError:
+            J_inv = np.linalg.pinv(JEE)
+        angles = np.array([0, np.pi * 32 / 180, 0, -(leg.q[1] + leg.q[2])])
+        null_filter = np.eye(len(leg.q)) - np.dot(J_inv, JEE)
+        return np.dot(J_inv, x_dd_des) + np.dot(null_filter, np.dot(self.kn, angles - leg.q))
+
+    def wbic_control(self, leg_l, leg_r, target_l, target_r, b_orient, force_l, force_r, c_l, c_r):
+        """
+        :param force_l: reaction force from the MPC for the left foot in the world frame, None for no reference
+        :param c_l: left foot in contact or not, forces of feet not in contact are held at zero
+        :return: joint torques of the left and right leg, in the sign convention of wbc.Control.wb_control
+        """
+        n_v = self.n_v
+        n_f = self.n_f
+        M, h, Jc = self.gen_model((leg_l, leg_r), b_orient)
+
+        # commanded accelerations and forces, the base is left free to move as the dynamics require
+        z_cmd = np.zeros(n_v + n_f)
+        z_cmd[6:10] = self.q_dd_cmd(0, leg_l, target_l)
+        z_cmd[10:14] = self.q_dd_cmd(1, leg_r, target_r)
+        if force_l is not None:
+            z_cmd[14:17] = force_l
+        if force_r is not None:
+            z_cmd[17:20] = force_r
+
+        g = -2 * self.w * z_cmd
+        A = np.zeros((len(self.lbg), n_v + n_f))
+        A[0:6, 0:n_v] = M[0:6]  # floating base rows, M*dv + h - Jc.T*f = 0
+        A[0:6, n_v:] = -Jc[:, 0:6].T
+        A[6:, n_v:] = self.fc
+        b = np.hstack([h[0:6], np.zeros(len(self.fc))])
+
+        lbx = np.full(n_v + n_f, -1e10)
+        ubx = np.full(n_v + n_f, 1e10)
+        lbx[n_v + 2::3] = 0  # fz >= 0
+        for k, c in enumerate((c_l, c_r)):
+            if not c:
+                lbx[n_v + 3 * k:n_v + 3 * (k + 1)] = 0  # no force from a foot in the air
+                ubx[n_v + 3 * k:n_v + 3 * (k + 1)] = 0
+
+        sol = self.solver(h=self.H, g=g, a=A, lba=self.lbg - b, uba=self.ubg - b, lbx=lbx, ubx=ubx,
+                          x0=self.x_prev, lam_x0=self.lam_x_prev, lam_a0=self.lam_g_prev)
+        if self.solver.stats()['success'] is False:
+            print("WARNING: WBIC QP failed (", self.solver.stats()['return_status'], ")")
+
+        self.x_prev = np.array(sol['x']).flatten()
+        self.lam_x_prev = np.array(sol['lam_x']).flatten()
+        self.lam_g_prev = np.array(sol['lam_a']).flatten()
+
+        self.q_dd = self.x_prev[0:n_v]
+        self.f = self.x_prev[n_v:]
+        tau = np.dot(M[6:], self.q_dd) + h[6:] - np.dot(Jc[:, 6:].T, self.f)
+
+        return tau[0:4], tau[4:8]
+
+
+def skew(r):
+    # cross product matrix, skew(a)*b = a x b
+    return np.array([[0, -r[2], r[1]],
+                     [r[2], 0, -r[0]],
+                     [-r[1], r[0], 0]])